@@ -1,54 +1,193 @@
 # Common Modules
+import argparse
 import logging
 import traceback
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Custom Modules
-from utils import stockload
-from utils.screener_utils import Screener
+from utils import http_archive, stockload
+from utils.adaptive_limit import AdaptiveConcurrency
+from utils.db_writer import DryRunDB
+from utils.job_queue import JobQueue
+from utils.proxy_pool import ProxyPool
+from utils.screener_utils import Screener, ScreenerUrlCache, company_symbol
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s :: %(name)s :: %(levelname)s -> %(message)s',
                     datefmt='%d-%b-%y %H:%M:%S')
 
-def main():
+failures = []
+
+
+def get_sector_info(row, proxy_pool, url_cache=None, resolved=None, harvest_peers=False, limiter=None):
     """
-    This functions acts as a driver for loading all securities available on the index
+    Resolves sector, industry and about for one stock_base row, runs on a worker thread
+    :param row: (stock_id, symbol, name)
+    :param proxy_pool: ProxyPool shared by all workers
+    :param url_cache: ScreenerUrlCache shared by all workers
+    :param resolved: stock_ids already resolved, e.g. as a peer of an earlier stock
+    :param harvest_peers: also return the stock's peer company urls
+    :param limiter: AdaptiveConcurrency shared by all workers
+    :return: ((sector, industry, about, stock_id), peer urls) or None when already resolved
+    """
+    if resolved is not None and row[0] in resolved:
+        return None
+    ticker_index = row[1].lower().find('-re')
+    name_index = row[2].lower().find('-re')
+    ticker = row[1][:ticker_index-1]
+    name = row[2][:name_index-1]
+    sc = Screener(ticker, name, proxy_pool=proxy_pool, url_cache=url_cache, cache_key=row[1], limiter=limiter)
+    stock_info = sc.stock_information(fields=("sector", "industry", "about"))
+    peers = []
+    if harvest_peers:
+        try:
+            peers = sc.peer_companies()
+        except Exception as e:
+            print(f'cannot get peers for {row}: {e}')
+    return (stock_info["sector"], stock_info["industry"], stock_info["about"], row[0]), peers
+
+
+def load_sectors(db_utils, sector_less_stocks, proxy_pool, url_cache=None, workers=8, batch_size=50,
+                 harvest_peers=True, job_queue=None):
+    """
+    Enriches sector-less stocks concurrently, a failing stock is recorded in failures and skipped.
+    With harvest_peers every resolved page also assigns its sector and industry to the sector-less peers,
+    which are then skipped, so pages are fetched roughly once per industry instead of once per stock.
+    :param db_utils: DBUtils instance
+    :param sector_less_stocks: rows from get_stock_without_sector
+    :param proxy_pool: ProxyPool shared by all workers
+    :param url_cache: ScreenerUrlCache, new resolutions are persisted with every batch
+    :param workers: most stocks resolved in parallel, fewer while screener is throttling
+    :param batch_size: resolved stocks written per UPDATE
+    :param harvest_peers: resolve peers from each fetched page
+    :param job_queue: JobQueue recording which stocks were resolved and which failed
     :return: None
     """
     logger = logging.getLogger(__name__)
-    logging.info("Starting with Stock Load")
-    db_utils = stockload.DBUtils()
-    index_table = db_utils.get_index_info('NSE')
-    for index in index_table:
-        index_obj = stockload.IndexUtils(index)
-        stocks_from_index = index_obj.get_stock_details()
-        db_utils.upsert_stocks(stocks_from_index)
-        logger.info("Completed Loading Stocks ")
-        sector_less_stocks = db_utils.get_stock_without_sector(index_id=1)
-        logger.info(f"Loading sector info for {sector_less_stocks}")
-
-        for i, row in enumerate(sector_less_stocks):
+    pending = {}
+    failed = []
+    resolved = set()
+    by_symbol = {row[1]: row for row in sector_less_stocks}
+    fetched = harvested = 0
+    limiter = AdaptiveConcurrency(initial=min(3, workers), maximum=workers, per_proxy_maximum=workers)
+
+    def flush():
+        if pending:
+            stock_ids = [values[3] for values in pending.values()]
+            if db_utils.update_stock_sector_batch(list(pending.values())):
+                if job_queue is not None:
+                    job_queue.done(stock_ids)
+            else:
+                failures.extend(pending)
+                failed.extend((stock_id, 'database write failed') for stock_id in stock_ids)
+        if job_queue is not None:
+            job_queue.failed(failed)
+        pending.clear()
+        failed.clear()
+        if url_cache is not None:
+            url_cache.flush()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(get_sector_info, row, proxy_pool, url_cache, resolved, harvest_peers, limiter): row
+                   for row in sector_less_stocks}
+        for future in as_completed(futures):
+            row = futures[future]
             try:
-                ticker_index = row[1].lower().find('-re')
-                name_index = row[2].lower().find('-re')
-                ticker = row[1][:ticker_index-1]
-                name = row[2][:name_index-1]
-                sc = Screener(ticker, name)
-                stock_info = sc.stock_information()
+                result = future.result()
             except Exception as e:
                 print('cannot get stock detail for ', row)
+                logger.debug(traceback.format_exc())
+                if row[0] not in resolved:
+                    failures.append(row)
+                    failed.append((row[0], f'{type(e).__name__}: {e}'))
                 continue
-            try:
-                db_utils.update_stock_sector([stock_info["sector"], stock_info["industry"], stock_info["about"], row[0]])
-            except Exception as e:
-                print("in load stocks", traceback.format_exc())
-                failures.append(row)
-                logger.error(e)
+            if result is None:
                 continue
+            (sector, industry, about, stock_id), peers = result
+            fetched += 1
+            pending[row] = (sector, industry, about, stock_id)
+            resolved.add(stock_id)
+            for url in peers:
+                peer = by_symbol.get(company_symbol(url))
+                if peer is None or peer[0] in resolved:
+                    continue
+                pending[peer] = (sector, industry, None, peer[0])
+                resolved.add(peer[0])
+                harvested += 1
+                if url_cache is not None:
+                    url_cache.put(peer[1], url)
+            if len(pending) >= batch_size:
+                flush()
+    flush()
+    logger.info(f"Sector info from {fetched} fetched pages, {harvested} more stocks resolved as peers")
+
+
+def main(workers=8, refresh_urls=False, force_index=False, record=None, replay=None):
+    """
+    This functions acts as a driver for loading all securities available on the index
+    :param workers: stocks enriched with sector info in parallel
+    :param refresh_urls: forget cached screener urls and search every stock again
+    :param force_index: diff the index csv against stock_base even when it has not changed
+    :param record: archive file every NSE and screener response is written to
+    :param replay: archive file every response is served from instead of the network, without proxies.
+        A replay only reads the database, nothing is written and no jobs are claimed
+    :return: None
+    """
+    logger = logging.getLogger(__name__)
+    logging.info("Starting with Stock Load")
+    if replay or record:
+        http_archive.install(http_archive.HttpArchive(replay or record,
+                                                      http_archive.REPLAY if replay else http_archive.RECORD))
+    proxy_pool = ProxyPool() if replay else ProxyPool.from_file('proxies.txt')
+    with stockload.DBUtils(max_pool_size=max(workers, 10)) as db_utils:
+        # Writes of a replay are only counted
+        target_db = DryRunDB(db_utils) if replay else db_utils
+        if not replay:
+            db_utils.migrate_stock_base()
+        index_table = db_utils.get_index_info('NSE')
+        for index in index_table:
+            index_obj = stockload.IndexUtils(index)
+            stocks_from_index = index_obj.get_stock_details(force=force_index)
+            if stocks_from_index is not None and not replay and db_utils.upsert_stocks(stocks_from_index):
+                index_obj.save_csv_cache()
+                logger.info("Completed Loading Stocks ")
+            sector_less_stocks = db_utils.get_stock_without_sector(index_id=1) or []
+            job_queue = None
+            if not replay:
+                # Stocks failing repeatedly back off instead of being searched on every run
+                job_queue = JobQueue(db_utils, 'sector')
+                wanted = {row[0] for row in sector_less_stocks}
+                job_queue.prepare(wanted)
+                sector_less_stocks, obsolete = [], []
+                for row in job_queue.claim():
+                    (sector_less_stocks if row[0] in wanted else obsolete).append(row)
+                # Jobs queued by an earlier run for stocks that got their sector since
+                job_queue.done([row[0] for row in obsolete])
+            logger.info(f"Loading sector info for {sector_less_stocks}")
+            url_cache = ScreenerUrlCache(target_db, index_obj.index_id)
+            if refresh_urls:
+                url_cache.invalidate()
+            with job_queue.heartbeat() if job_queue is not None else nullcontext():
+                load_sectors(target_db, sector_less_stocks, proxy_pool, url_cache=url_cache, workers=workers,
+                             job_queue=job_queue)
+    if failures:
+        logger.warning(f"Could not load sector info for {len(failures)} stocks: {failures}")
+
 
 if __name__ == '__main__':
-    failures = []
+    parser = argparse.ArgumentParser(description="Load index constituents and their sector info")
+    parser.add_argument("--workers", type=int, default=8, help="stocks enriched with sector info in parallel")
+    parser.add_argument("--refresh-urls", action="store_true", help="ignore cached screener urls and search again")
+    parser.add_argument("--force-index", action="store_true", help="sync stock_base even if the index csv is unchanged")
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument("--record", metavar="ARCHIVE", help="write every response to this archive file")
+    archive_group.add_argument("--replay", metavar="ARCHIVE",
+                               help="serve every response from this archive file instead of NSE and screener.in, "
+                                    "without writing to the database")
+    args = parser.parse_args()
     try:
-        main()
+        main(workers=args.workers, refresh_urls=args.refresh_urls, force_index=args.force_index, record=args.record,
+             replay=args.replay)
     except KeyboardInterrupt:
         print(failures)
@@ -0,0 +1,274 @@
+# Common Modules
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from bs4 import BeautifulSoup
+from psycopg2.extensions import adapt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Custom Modules
+from utils import stockload
+from utils.extract_yearly_data import extract_yearly_data_from_html, extract_yearly_data_from_soup
+from utils.proxy_pool import ProxyPool
+from utils.screener_utils import Screener
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+
+def load_fixtures():
+    """
+    :return: dict of fixture name -> raw page bytes
+    """
+    fixtures = {}
+    for file_name in sorted(os.listdir(FIXTURES_DIR)):
+        if file_name.endswith('.html'):
+            with open(os.path.join(FIXTURES_DIR, file_name), 'rb') as f:
+                fixtures[file_name[:-len('.html')]] = f.read()
+    return fixtures
+
+
+def time_call(func, repeat):
+    """
+    :return: median seconds of repeat calls of func
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def peak_memory(func):
+    """
+    :return: peak bytes allocated by python while func runs, memory lxml allocates in C is not counted
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class _FixtureUrlCache:
+    # Stands in for ScreenerUrlCache so Screener resolves its url without the search api
+    def get(self, symbol):
+        return True, f'/company/{symbol}/consolidated/'
+
+
+def fixture_screener(name, page):
+    screener = Screener(name, name, proxy_pool=ProxyPool(), url_cache=_FixtureUrlCache())
+    screener._page = page
+    return screener
+
+
+def bench_parse(fixtures, repeat):
+    """
+    Parse time and peak memory per page for every extraction path
+    :return: dict of fixture -> path -> {ms, peak_kb}
+    """
+    paths = {
+        'lxml': extract_yearly_data_from_html,
+        'soup_lxml': lambda page: extract_yearly_data_from_soup(page, parse=True),
+        'soup_html_parser': lambda page: extract_yearly_data_from_soup(BeautifulSoup(page, 'html.parser')),
+        'stock_information': lambda page: fixture_screener('BENCH', page).stock_information(),
+    }
+    results = {}
+    for name, page in fixtures.items():
+        results[name] = {}
+        for path, parse in paths.items():
+            results[name][path] = {
+                'ms': round(time_call(lambda: parse(page), repeat) * 1000, 3),
+                'peak_kb': round(peak_memory(lambda: parse(page)) / 1024, 1),
+            }
+    return results
+
+
+class _StandInCursor:
+    # Accepts statements like a psycopg2 cursor without a server, so only client side cost is measured
+    def __init__(self, connection):
+        self.connection = connection
+
+    def mogrify(self, query, args):
+        if isinstance(query, str):
+            query = query.encode()
+        return query % tuple(adapt(arg).getquoted() for arg in args)
+
+    def execute(self, query, args=None):
+        if args is not None:
+            query = self.mogrify(query, args)
+        self.connection.statements += 1
+
+    def executemany(self, query, args_list):
+        for args in args_list:
+            self.execute(query, args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class _StandInConnection:
+    encoding = 'UTF8'
+
+    def __init__(self):
+        self.statements = 0
+
+    def cursor(self):
+        return _StandInCursor(self)
+
+
+class StandInDBUtils(stockload.DBUtils):
+    """
+    DBUtils whose connections only build statements, for measuring the client side of the upserts offline
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.trim_soup = False
+        self.stand_in = _StandInConnection()
+
+    @contextmanager
+    def connection(self):
+        yield self.stand_in
+
+    def close(self):
+        pass
+
+
+def local_db_utils():
+    """
+    DBUtils for the database in STONKS_DB_CREDS with a session local copy of yearly_financial_data,
+    so benchmark rows shadow the real table and vanish with the connection
+    """
+    db_utils = stockload.DBUtils(min_pool_size=1, max_pool_size=1)
+    with db_utils.connection() as conn, conn.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS yearly_financial_data "
+                       "(LIKE public.yearly_financial_data INCLUDING ALL)")
+    return db_utils
+
+
+def bench_db(fixtures, db_utils, stocks, repeat):
+    """
+    Rows per second of the per stock and the batched yearly fundamentals upserts
+    :param stocks: stocks written per run, cycling through the fixtures
+    :return: dict of upsert -> {rows, seconds, rows_per_sec}
+    """
+    parsed = [extract_yearly_data_from_html(page) for page in fixtures.values()]
+    parsed = [(col_headers, yearly_data) for col_headers, yearly_data, _ in parsed if col_headers]
+    work = [(stock_id, *parsed[stock_id % len(parsed)]) for stock_id in range(1, stocks + 1)]
+    rows = sum(len(yearly_data) for _, _, yearly_data in work)
+
+    def per_stock():
+        for stock_id, col_headers, yearly_data in work:
+            db_utils.upsert_yearly_fundamentals(stock_id, col_headers, yearly_data)
+
+    def batched():
+        grouped = {}
+        for stock_id, col_headers, yearly_data in work:
+            grouped.setdefault(tuple(col_headers), []).extend(
+                [stock_id, year, *data] for year, data in yearly_data.items())
+        for col_headers, group in grouped.items():
+            db_utils.upsert_yearly_fundamentals_batch(list(col_headers), group)
+
+    results = {}
+    for name, run in (('per_stock', per_stock), ('batch', batched)):
+        seconds = time_call(run, repeat)
+        results[name] = {'rows': rows, 'seconds': round(seconds, 4), 'rows_per_sec': round(rows / seconds)}
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(results, baseline):
+    """
+    Prints every measurement next to the baseline with the relative change
+    """
+    current, previous = flatten(results['benchmarks']), flatten(baseline['benchmarks'])
+    print(f"{'measurement':70} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key in sorted(current):
+        if key in previous and previous[key]:
+            change = (current[key] - previous[key]) / previous[key] * 100
+            print(f"{key:70} {previous[key]:>12} {current[key]:>12} {change:>+7.1f}%")
+
+
+def main(repeat=20, stocks=200, db='stand-in', label=None, baseline=None):
+    """
+    Runs the offline benchmarks against the checked in fixtures and saves the results as json
+    :param repeat: runs per measurement, the median is kept
+    :param stocks: stocks written per DB upsert run
+    :param db: stand-in to only build statements, local to write to the database in STONKS_DB_CREDS
+    :param label: results file name, defaults to the git revision
+    :param baseline: results file to compare against
+    :return: results dict
+    """
+    fixtures = load_fixtures()
+    db_utils = StandInDBUtils() if db == 'stand-in' else local_db_utils()
+    try:
+        results = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'db': db,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks': {
+                'parse': bench_parse(fixtures, repeat),
+                'db_upsert': bench_db(fixtures, db_utils, stocks, max(1, repeat // 10)),
+            },
+        }
+    finally:
+        db_utils.close()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{label or results['revision'] or 'latest'}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results['benchmarks'], indent=2))
+    print(f"Saved results to {path}")
+    if baseline:
+        with open(baseline, 'r') as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the parse and DB write hot paths")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per measurement, the median is reported")
+    parser.add_argument("--stocks", type=int, default=200, help="stocks written per DB upsert run")
+    parser.add_argument("--db", choices=["stand-in", "local"], default="stand-in",
+                        help="stand-in: build statements without a server, local: database in STONKS_DB_CREDS")
+    parser.add_argument("--label", help="results file name under benchmarks/results, defaults to the git revision")
+    parser.add_argument("--baseline", help="results json to compare against")
+    args = parser.parse_args()
+    main(repeat=args.repeat, stocks=args.stocks, db=args.db, label=args.label, baseline=args.baseline)
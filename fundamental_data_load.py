@@ -1,15 +1,24 @@
+import argparse
+from contextlib import nullcontext
 import os
 import sys
 import time
 import threading
 import random
 
-from queue import Queue
+from queue import Empty, Full, Queue
 
 import requests
-from bs4 import BeautifulSoup
 
-from utils import proxy_scraper, proxy_checker, stockload, extract_yearly_data
+from utils import http_archive, proxy_scraper, proxy_checker, stockload, page_fingerprint
+from utils.adaptive_limit import AdaptiveConcurrency
+from utils.async_fetch import AsyncFetchEngine, parse_executor, parse_page
+from utils.crawl_metrics import CrawlMetrics, PARSE_BUCKETS
+from utils.db_writer import BatchWriter, DryRunDB
+from utils.job_queue import JobQueue
+from utils.proxy_cache import ProxyCache
+from utils.proxy_pool import ProxyPool, requests_proxies
+from utils.statement_variant import DEFAULT_VARIANT, changed_variant, company_url, other_variant_url, variant_of
 
 
 INDEX_ID = 1
@@ -17,23 +26,47 @@ db_utils = stockload.DBUtils()
 
 
 # Function to read proxies from the file
-def load_proxies(proxies_file):
+def load_proxies(proxies_file, cache_file='proxy_cache.json'):
     # if file not found or if file older than a half hour
     if not os.path.isfile(proxies_file) or time.time() - os.path.getmtime(proxies_file) > 60 * 60 / 4:
-        proxy_scraper.scraper(proxy='http', output=proxies_file, verbose=False)
-        proxy_checker.checker(file=proxies_file, verbose=False)
+        refresh_proxies(proxies_file, cache_file)
+    # Each line is "ip:port latency" as written by proxy_checker, older files only have ip:port
     with open(proxies_file, 'r') as f:
-        proxies = [line.strip() for line in f]
+        proxies = [line.split() for line in f if line.strip()]
     duplicate_check = set()
     proxy_without_duplicate = []
-    for proxy in proxies:
+    for proxy, *latency in proxies:
         if proxy.split(':')[0] not in duplicate_check:
-            proxy_without_duplicate.append(proxy)
+            proxy_without_duplicate.append((proxy, float(latency[0]) if latency else None))
             duplicate_check.add(proxy.split(':')[0])
     print(f'Found {len(proxy_without_duplicate)} proxies to use')
     return proxy_without_duplicate
 
 
+def refresh_proxies(proxies_file, cache_file, keep_for=60 * 60):
+    """
+    Scrapes only the sources whose cached list expired and validates only proxies not already known good,
+    proxies validated within keep_for seconds are carried over as they are
+    """
+    cache = ProxyCache(cache_file)
+    proxy_scraper.scraper(proxy='http', output=proxies_file, verbose=False, cache=cache)
+    with open(proxies_file, 'r') as f:
+        scraped = {line.strip() for line in f if line.strip()}
+    kept = cache.kept_proxies(max_age=keep_for)
+    with open(proxies_file, 'w') as f:
+        f.write("\n".join(scraped - kept.keys()))
+    checked, valid = proxy_checker.checker(file=proxies_file, verbose=False, max_valid=200)
+    cache.record_check(checked, valid)
+    cache.save()
+    for source, scraped_count, valid_count, source_yield, dead_runs in cache.report():
+        print(f'{source}: scraped {scraped_count}, valid {valid_count}, yield {source_yield}, dead runs {dead_runs}')
+
+    merged = {**kept, **valid}
+    with open(proxies_file, 'w') as f:
+        for proxy in sorted(merged, key=merged.get):
+            f.write(f"{proxy} {merged[proxy]:.3f}\n")
+
+
 def load_user_agents(user_agents_file):
     user_agents = []
     with open(user_agents_file, "r") as f:
@@ -42,87 +75,356 @@ def load_user_agents(user_agents_file):
     return user_agents
 
 
-# Function to make requests and save the content
-def fetch_url(queue, proxy_list, user_agent_list):
-    while not queue.empty():
-        proxy_str = random.choice(proxy_list)
-        user_agent = random.choice(user_agent_list)
-        headers = {'User-Agent': user_agent}
-        stock_id, url = queue.get()
-        print(f'Processing: {stock_id}->{url}')
-        proxy = {'http': f'http://{proxy_str}'}
+def get_page(url, headers, proxy_pool, metrics, limiter):
+    """
+    GET through a proxy picked from the pool once the adaptive limiter has room for it,
+    the outcome is fed back into the pool's health stats and the limiter
+    :return: response, proxy used
+    """
+    proxy_str = limiter.acquire(proxy_pool.choose)
+    status = error = retry_after = None
+    try:
+        response = http_archive.get(url, timeout=10, headers=headers, proxies=requests_proxies(proxy_str))
+        status, retry_after = response.status_code, response.headers.get('Retry-After')
+    except Exception as e:
+        error = e
+        proxy_pool.report_failure(proxy_str)
+        metrics.inc('fetch_errors', proxy=proxy_str or 'direct', error=type(e).__name__)
+        raise
+    finally:
+        # Exactly one release per acquire, a leaked slot would lower the concurrency for the rest of the run
+        limiter.release(proxy_str, status, error=error, retry_after=retry_after)
+    metrics.observe('fetch_seconds', response.elapsed.total_seconds(), proxy=proxy_str or 'direct')
+    metrics.inc('fetch_responses', status=response.status_code)
+    if response.status_code in (403, 407, 429) or response.status_code >= 500:
+        proxy_pool.report_failure(proxy_str)
+    else:
+        proxy_pool.report_success(proxy_str, response.elapsed.total_seconds())
+    return response, proxy_str
+
+
+def fetch_url(fetch_queue, parse_queue, stop, proxy_pool, user_agent_list, writer, fingerprints, variants, metrics,
+              limiter, deadline=None):
+    """
+    Fetch stage, only downloads and hands 200 responses to the parse stage, blocking while the parse queue is full.
+    A job handed to the parse stage stays unfinished in fetch_queue until the parse stage is done with it.
+    """
+    while not stop.is_set():
         try:
-            response = requests.get(url, timeout=10, headers=headers)
+            stock_id, url = fetch_queue.get(timeout=0.1)
+        except Empty:
+            continue
+        proxy_str = None
+        handed_off = False
+        try:
+            if deadline is not None and time.monotonic() >= deadline:
+                # Left running in crawl_job, released for the next run
+                continue
+            headers = {'User-Agent': random.choice(user_agent_list)}
+            headers.update(page_fingerprint.conditional_headers(fingerprints.get(stock_id)))
+            print(f'Processing: {stock_id}->{url}')
+            response, proxy_str = get_page(url, headers, proxy_pool, metrics, limiter)
             print('Response:', response.status_code)
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.content, 'lxml')
-                if soup == '':
-                    print(f'Check this URL -> returned empty content')
-                    continue
-                col_headers, yearly_data, is_standalone = extract_yearly_data.extract_yearly_data_from_soup(soup)
-                if is_standalone:
-                    print(f"Processing Standalone: {stock_id}->{url.replace('/consolidated/', '/')}")
-                    response = requests.get(url.replace('/consolidated/', '/'), timeout=10, headers=headers)
-                    print('Response:', response.status_code)
-                    if response.status_code == 200:
-                        soup = BeautifulSoup(response.content, 'lxml')
-                        if soup == '':
-                            print(f'Check this URL -> returned empty content')
-                            continue
-                        col_headers, yearly_data, is_standalone = \
-                            extract_yearly_data.extract_yearly_data_from_soup(soup)
-                    if is_standalone:
-                        print(f"soup is still doubtful {url.replace('/consolidated/', '/')}\n")
+            if response.status_code == 304:
+                print(f'Unchanged since last fetch: {stock_id}')
+                metrics.inc('pages_unchanged', check='not_modified')
+                # The variant may never have been saved when the page was stored
+                writer.add_page(stock_id, page_fingerprint.from_response(response, None),
+                                variant=changed_variant(url, variants.get(stock_id)))
+            elif response.status_code == 200 and not response.content:
+                print(f'Check this URL -> returned empty content')
+                metrics.inc('pages_failed', stage='fetch')
+                writer.add_job_failed(stock_id, 'empty content')
+            elif response.status_code == 200:
+                # Waits for room in the parse queue, unless the pipeline is being stopped
+                while not stop.is_set():
+                    try:
+                        parse_queue.put((stock_id, url, response), timeout=0.1)
+                    except Full:
                         continue
-                db_utils.upsert_soup(stock_id, str(soup))
-                db_utils.upsert_yearly_fundamentals(stock_id, col_headers, yearly_data)
-                print()
+                    handed_off = True
+                    break
+                metrics.set_gauge('queue_depth', parse_queue.qsize(), queue='parse')
             else:
                 print(f"Failed to fetch url with status code {response.status_code} with proxy : {proxy_str}")
-            time.sleep(1)
+                metrics.inc('pages_failed', stage='fetch')
+                writer.add_job_failed(stock_id, f'status code {response.status_code}')
         except requests.RequestException as e:
             print(f"Request failed for {url}: {e}")
-            continue
+            metrics.inc('pages_failed', stage='fetch')
+            writer.add_job_failed(stock_id, f'{type(e).__name__}: {e}')
+        except Exception as e:
+            print(f"Could not fetch {url}: {e}")
+            metrics.inc('pages_failed', stage='fetch')
+            writer.add_job_failed(stock_id, f'{type(e).__name__}: {e}')
         finally:
-            queue.task_done()
-
-def scrape_soup(sector, urls, stock_id_list, proxies, user_agents):
-    print(f"Starting to scrape for sector: {sector} with no of urls: {len(urls)}")
-    queue = Queue()
-    for index, url in enumerate(urls):
-        queue.put((stock_id_list[index], url))
+            if not handed_off:
+                fetch_queue.task_done()
 
-    # Define the number of threads
-    num_threads = min(len(urls), 3)
 
-    # Create and start threads
-    threads = []
-    for i in range(num_threads):
+def parse_worker(fetch_queue, parse_queue, stop, executor, writer, fingerprints, variants, metrics):
+    """
+    Parse stage, hashes and extracts pages in the process pool and passes the results to the batch writer.
+    A doubtful page of the stock's remembered statement variant goes back to the fetch stage as the other variant,
+    the variant that gave valid data is remembered for the next run.
+    """
+    while not stop.is_set():
         try:
-            thread = threading.Thread(target=fetch_url, args=(queue, proxies, user_agents))
-            thread.start()
-            threads.append(thread)
-        except Exception as e:
-            print(f"Failed to scrape proxy: {proxies}: {e}")
+            stock_id, url, response = parse_queue.get(timeout=0.1)
+        except Empty:
             continue
+        try:
+            stored = fingerprints.get(stock_id)
+            page_hash, parsed, timings = executor.submit(parse_page, response.content,
+                                                         stored and stored.content_hash).result()
+            for step, seconds in timings.items():
+                metrics.observe('parse_seconds', seconds, PARSE_BUCKETS, step=step)
+            fingerprint = page_fingerprint.from_response(response, page_hash)
+            if parsed is None:
+                # Same financial sections as the stored page, nothing to parse or write
+                print(f'Unchanged since last fetch: {stock_id}')
+                metrics.inc('pages_unchanged', check='content_hash')
+                writer.add_page(stock_id, fingerprint, variant=changed_variant(url, variants.get(stock_id)))
+                continue
+            col_headers, yearly_data, doubt = parsed
+            expected = variants.get(stock_id, DEFAULT_VARIANT)
+            if doubt:
+                if variant_of(url) == expected:
+                    fallback_url = other_variant_url(url)
+                    print(f"Processing {variant_of(fallback_url).title()}: {stock_id}->{fallback_url}")
+                    metrics.inc('retries', reason=variant_of(fallback_url))
+                    fetch_queue.put((stock_id, fallback_url))
+                else:
+                    print(f"soup is still doubtful {url}\n")
+                    metrics.inc('pages_failed', stage='doubtful')
+                    writer.add_job_failed(stock_id, 'doubtful yearly data')
+                continue
+            # Store the original bytes, re-serializing the parsed tree is both slower and larger
+            writer.add_page(stock_id, fingerprint, response.content, col_headers, yearly_data,
+                            variant=changed_variant(url, variants.get(stock_id)))
+            metrics.inc('pages_parsed')
+        except Exception as e:
+            # e.g. a page without one of the yearly sections, keep the stage alive for the next stock
+            print(f"Could not process {url}: {e}")
+            metrics.inc('pages_failed', stage='parse')
+            writer.add_job_failed(stock_id, f'{type(e).__name__}: {e}')
+        finally:
+            parse_queue.task_done()
+            # Finishes the fetch job this page came from, after a fallback url was queued as a new one
+            fetch_queue.task_done()
+
+
+def run_stage(stage, stop, errors, *args):
+    """
+    Thread target of a pipeline stage, a stage that dies, e.g. on a WriterError once the flusher stopped,
+    stops the whole pipeline instead of leaving scrape_soup waiting on jobs nobody takes anymore
+    """
+    try:
+        stage(*args)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
 
-    # Wait for all threads to complete
+
+def scrape_soup(jobs, proxy_pool, user_agents, writer, fingerprints, variants, metrics, limiter, executor, workers=32,
+                parse_workers=None, queue_size=100, deadline=None):
+    """
+    Runs the crawl as three stages sized to their own bottleneck: fetch threads for the network,
+    a process pool for parsing and the BatchWriter thread for the database, joined by bounded queues
+    so a slow stage holds back the one feeding it instead of buffering without limit
+    :param jobs: list of (stock_id, url), taken in order so the most outdated pages go first
+    :param variants: dict of stock_id -> statement variant the jobs' urls were built for
+    :param limiter: AdaptiveConcurrency deciding how many of the threads may have a request in flight
+    :param executor: process pool running parse_page
+    :param workers: fetch threads for the whole run, the ceiling of the adaptive concurrency
+    :param parse_workers: pages parsed at once, defaults to the CPU count
+    :param queue_size: fetched pages waiting for the parse stage before fetchers block
+    :param deadline: time.monotonic() after which no new page is started, the rest stays queued in crawl_job
+    """
+    parse_workers = parse_workers or os.cpu_count() or 1
+    print(f"Starting to scrape {len(jobs)} urls with {workers} fetch threads and {parse_workers} parse workers")
+    fetch_queue = Queue()
+    parse_queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    for stock_id, url in jobs:
+        fetch_queue.put((stock_id, url))
+
+    threads = [threading.Thread(target=run_stage, name=f'fetch-{i}',
+                                args=(fetch_url, stop, errors, fetch_queue, parse_queue, stop, proxy_pool, user_agents,
+                                      writer, fingerprints, variants, metrics, limiter, deadline))
+               for i in range(min(len(jobs), workers))]
+    threads += [threading.Thread(target=run_stage, name=f'parse-{i}',
+                                 args=(parse_worker, stop, errors, fetch_queue, parse_queue, stop, executor, writer,
+                                       fingerprints, variants, metrics))
+                for i in range(parse_workers)]
     for thread in threads:
-        thread.join()
+        thread.start()
+    try:
+        # A job only leaves fetch_queue once fetched and parsed, fallback urls are queued before that,
+        # so an empty fetch_queue means nothing is left in either stage.
+        # Jobs still queued when a stage or the writer died are abandoned, they stay leased in crawl_job
+        while not stop.is_set():
+            with fetch_queue.all_tasks_done:
+                if not fetch_queue.unfinished_tasks:
+                    break
+                fetch_queue.all_tasks_done.wait(timeout=0.5)
+            writer.check()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    print("Scraping completed")
 
-    # Without Threads
-    # fetch_url(queue, proxies, user_agents)
 
-    print("Scraping completed for sector: {}".format(sector))
+def crawl(jobs, engine, proxy_pool, user_agents, writer, fingerprints, variants, metrics, limiter, executor, workers,
+          concurrency, rate, parse_workers=None, queue_size=100, deadline=None):
+    """
+    Fetches and parses the pages of the given stocks with the chosen engine
+    :param jobs: list of (stock_id, url of the remembered statement variant), most outdated first
+    :param executor: process pool shared by every batch, so workers are spawned once per run
+    """
+    if engine == 'async':
+        AsyncFetchEngine(writer, user_agents, fingerprints, variants=variants, proxy_pool=proxy_pool,
+                         concurrency=concurrency, rate=rate, parse_workers=parse_workers, queue_size=queue_size,
+                         metrics=metrics, limiter=limiter, executor=executor).run(jobs, deadline=deadline)
+    else:
+        scrape_soup(jobs, proxy_pool, user_agents, writer, fingerprints, variants, metrics, limiter, executor,
+                    workers=workers, parse_workers=parse_workers, queue_size=queue_size, deadline=deadline)
 
 
 # Main function to set up the threads and start scraping
-def main():
-    proxies = load_proxies('proxies.txt')
+def main(engine='threads', workers=32, concurrency=200, rate=3, initial_concurrency=3, time_budget=None,
+         metrics_file='crawl_metrics.json', prometheus_file=None, worker_id=None, batch_size=500, lease_seconds=600,
+         claim_only=False, parse_workers=None, queue_size=100, record=None, replay=None, retry_failed=False):
+    """
+    Any number of these may run at once on different hosts, each leases batches of stale stocks from crawl_job
+    :param workers: fetch threads of the threads engine, the most requests it may grow to
+    :param initial_concurrency: requests in flight at the start, grown while responses are healthy
+    :param time_budget: seconds after which no new page is started, the most outdated pages are fetched first
+    :param metrics_file: json summary of the run's fetch, parse and DB metrics
+    :param prometheus_file: also write the metrics in the Prometheus text format, e.g. for a textfile collector
+    :param worker_id: name this worker leases jobs under, host:pid by default
+    :param batch_size: stocks leased per claim
+    :param lease_seconds: seconds after which the stocks of a worker that stopped heartbeating go to another worker
+    :param claim_only: do not look for stale stocks, only work off jobs queued by another worker
+    :param parse_workers: parse processes, defaults to the CPU count
+    :param queue_size: fetched pages waiting to be parsed before the fetchers block
+    :param retry_failed: queue stale stocks whose job ran out of attempts again right away instead of after a week
+    :param record: archive file every response is written to
+    :param replay: archive file every response is served from instead of the network, without proxies.
+        A replay parses every listed stock of the index and leaves the database untouched: no jobs are leased
+        and rows are only counted, not written
+    """
+    deadline = time.monotonic() + time_budget if time_budget else None
+    archive = http_archive.HttpArchive(replay, http_archive.REPLAY) if replay \
+        else http_archive.HttpArchive(record, http_archive.RECORD) if record else None
+    http_archive.install(archive)
     user_agents = load_user_agents('user_agents.txt')
-    urls = db_utils.get_stock_urls(index_id=INDEX_ID)
-    for sector, url_list, stock_id_list in urls:
-        scrape_soup(sector, url_list, stock_id_list, proxies, user_agents)
+    metrics = CrawlMetrics()
+    if not replay:
+        db_utils.migrate_raw_soup_base()
+        db_utils.migrate_stock_base()
+    # Without fingerprints a replay parses every archived page instead of skipping the ones already stored
+    fingerprints = {} if replay else db_utils.get_page_fingerprints(index_id=INDEX_ID)
+    # Stocks without consolidated statements are requested as standalone straight away
+    variants = db_utils.get_statement_variants(index_id=INDEX_ID)
+    if replay:
+        job_queue = None
+        symbols = {stock_id: symbol for symbol, (stock_id, *_) in (db_utils.get_screener_urls(INDEX_ID) or {}).items()}
+        replay_rows = [(stock_id, symbols[stock_id], None)
+                       for stock_id, _ in db_utils.get_stale_stocks(index_id=INDEX_ID, max_age='0 second') or []
+                       if stock_id in symbols]
+    else:
+        # Progress lives in crawl_job, an interrupted run picks up exactly the stocks it had not finished
+        job_queue = JobQueue(db_utils, 'fundamentals', worker_id=worker_id, lease_seconds=lease_seconds,
+                             failed_cooldown='0 second' if retry_failed else '7 day')
+        if claim_only:
+            job_queue.prepare()
+        else:
+            # One global list ordered by staleness instead of one batch per sector
+            stale = db_utils.get_stale_stocks(index_id=INDEX_ID) or []
+            job_queue.prepare([stock_id for stock_id, _ in stale],
+                              priorities={stock_id: rank for rank, (stock_id, _) in enumerate(stale)})
+
+    def next_batch():
+        if job_queue is not None:
+            return job_queue.claim(batch_size)
+        batch = replay_rows[:batch_size]
+        del replay_rows[:batch_size]
+        return batch
+
+    try:
+        # Writes from every stock share one buffer and are flushed in bulk
+        with parse_executor(parse_workers) as executor, \
+                BatchWriter(DryRunDB() if replay else db_utils, metrics=metrics, job_queue=job_queue) as writer, \
+                job_queue.heartbeat() if job_queue is not None else nullcontext():
+            # A replay never leaves the machine, so there is nothing to route through proxies
+            proxy_pool = ProxyPool() if replay else ProxyPool(load_proxies('proxies.txt'))
+            maximum = concurrency if engine == 'async' else workers
+            # Nothing to be polite to in a replay, start at full concurrency
+            limiter = AdaptiveConcurrency(initial=maximum if replay else initial_concurrency, maximum=maximum,
+                                          metrics=metrics)
+            # Batches keep the leases short lived, failures whose backoff ran out are picked up by a later claim
+            while deadline is None or time.monotonic() < deadline:
+                leased = next_batch()
+                if not leased:
+                    break
+                jobs = [(stock_id, company_url(symbol, variants.get(stock_id, DEFAULT_VARIANT)))
+                        for stock_id, symbol, _ in leased]
+                crawl(jobs, engine, proxy_pool, user_agents, writer, fingerprints, variants, metrics, limiter, executor,
+                      workers, concurrency, rate, parse_workers, queue_size, deadline)
+                writer.flush()
+    finally:
+        # Stocks leased but not started before the deadline go straight back to the other workers
+        if job_queue is not None:
+            job_queue.release()
+        db_utils.close()
+        if archive is not None:
+            http_archive.install(None)
+            archive.close()
+        metrics.write_json(metrics_file)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load yearly fundamentals from screener.in")
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads",
+                        help="threads: worker threads on one global queue, async: single event loop crawler")
+    parser.add_argument("--workers", type=int, default=32,
+                        help="fetch threads for the threads engine, the most requests in flight it may grow to")
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="most requests in flight the async engine may grow to")
+    parser.add_argument("--initial-concurrency", type=int, default=3,
+                        help="requests in flight at the start, adapted to the responses from there")
+    parser.add_argument("--rate", type=float, default=3, help="requests per second per host for the async engine")
+    parser.add_argument("--time-budget", type=float, help="seconds after which no new page is started")
+    parser.add_argument("--metrics-file", default="crawl_metrics.json", help="json summary of the run's metrics")
+    parser.add_argument("--prometheus-file", help="also write the metrics in the Prometheus text format")
+    parser.add_argument("--worker-id",
+                        help="name this worker leases jobs under, unique per process, host:pid by default")
+    parser.add_argument("--batch-size", type=int, default=500, help="stocks leased from crawl_job per claim")
+    parser.add_argument("--lease-seconds", type=int, default=600,
+                        help="seconds before the stocks of a worker that stopped heartbeating are handed out again")
+    parser.add_argument("--claim-only", action="store_true",
+                        help="skip the stale stock scan and only work off jobs queued by another worker")
+    parser.add_argument("--parse-workers", type=int, help="parse processes, defaults to the CPU count")
+    parser.add_argument("--queue-size", type=int, default=100,
+                        help="fetched pages waiting to be parsed before the fetchers block")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="give stale stocks whose job ran out of attempts a fresh set now instead of after a week")
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument("--record", metavar="ARCHIVE", help="write every response to this archive file")
+    archive_group.add_argument("--replay", metavar="ARCHIVE",
+                               help="serve every response from this archive file instead of screener.in without "
+                                    "writing to the database, raise --rate as well to replay at full speed with "
+                                    "the async engine")
+    args = parser.parse_args()
+    main(engine=args.engine, workers=args.workers, concurrency=args.concurrency, rate=args.rate,
+         initial_concurrency=args.initial_concurrency, time_budget=args.time_budget, metrics_file=args.metrics_file, prometheus_file=args.prometheus_file,
+         worker_id=args.worker_id, batch_size=args.batch_size, lease_seconds=args.lease_seconds,
+         claim_only=args.claim_only, parse_workers=args.parse_workers, queue_size=args.queue_size,
+         record=args.record, replay=args.replay, retry_failed=args.retry_failed)
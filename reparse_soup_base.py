@@ -0,0 +1,52 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import stockload, extract_yearly_data
+from utils.db_writer import BatchWriter
+from utils.soup_codec import decode_soup
+
+
+def reparse_row(row):
+    """
+    Runs in a worker process, decompression and parsing both stay off the main process
+    :param row: (stock_id, screener_soup, screener_soup_zip)
+    :return: stock_id, col_headers, yearly_data, doubt
+    """
+    stock_id, soup, soup_zip = row
+    try:
+        html = decode_soup(soup, soup_zip)
+        col_headers, yearly_data, doubt = extract_yearly_data.extract_yearly_data_from_html(html)
+        return stock_id, col_headers, yearly_data, doubt
+    except Exception as e:
+        print(f"Could not re-parse {stock_id}: {e}")
+        return stock_id, None, None, True
+
+
+# Re-derive yearly fundamentals from stored pages without crawling again
+def main(batch_size=200, workers=None, interval='1 month'):
+    start = time.time()
+    parsed = skipped = 0
+    with stockload.DBUtils() as db_utils, \
+            BatchWriter(db_utils) as writer, \
+            ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for batch in db_utils.iter_soup_base(batch_size=batch_size, interval=interval, decode=False):
+            for stock_id, col_headers, yearly_data, doubt in executor.map(reparse_row, batch, chunksize=8):
+                if doubt or not yearly_data:
+                    print(f"soup is doubtful for {stock_id}, skipping")
+                    skipped += 1
+                    continue
+                writer.add_yearly_fundamentals(stock_id, col_headers, yearly_data)
+                parsed += 1
+            print(f"Re-parsed {parsed} stocks, skipped {skipped}")
+    print(f"Re-parse completed in {time.time() - start:.1f} seconds")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-extract yearly fundamentals from raw_soup_base")
+    parser.add_argument("--batch-size", type=int, default=200, help="rows streamed from the database per batch")
+    parser.add_argument("--workers", type=int, default=None, help="parse processes, defaults to the CPU count")
+    parser.add_argument("--interval", default='1 month', help="only pages modified within this postgres interval")
+    args = parser.parse_args()
+    main(batch_size=args.batch_size, workers=args.workers, interval=args.interval)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from utils.derived_metrics import derived_metrics
+from utils.fundamentals import FundamentalsPanel
+
+# Column names as yearly_financial_data returns them, Postgres folds the unquoted identifiers to lowercase
+DB_COLUMNS = ['stock_id', 'year', 'sales', 'operating_profit', 'net_profit', 'equity_capital', 'reserves']
+DB_ROWS = [
+    (1, 2022, 100.0, 20.0, 10.0, 5.0, 45.0),
+    (1, 2023, 120.0, 30.0, 15.0, 5.0, 55.0),
+    (2, 2023, 50.0, None, 5.0, 10.0, 40.0),
+]
+
+
+def test_panel_from_db_rows_resolves_canonical_metric_names():
+    panel = FundamentalsPanel.from_rows(DB_COLUMNS, DB_ROWS)
+    assert panel.shape == (2, 2, 5)
+    assert 'Net_Profit' in panel
+    np.testing.assert_array_equal(panel.metric('Sales'), [[100.0, 120.0], [np.nan, 50.0]])
+    assert np.isnan(panel.metric('Operating_Profit')[1, 1])
+
+
+def test_derived_metrics_on_db_panel_are_not_all_nan():
+    metrics = derived_metrics(FundamentalsPanel.from_rows(DB_COLUMNS, DB_ROWS))
+    np.testing.assert_allclose(metrics['sales_growth'][0, 1], 0.2)
+    np.testing.assert_allclose(metrics['net_margin'][:, 1], [12.5, 10.0])
+    np.testing.assert_allclose(metrics['roe'][0], [20.0, 25.0])
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Responses meaning the site or the proxy wants us to slow down
+THROTTLE_STATUSES = {403, 429}
+
+
+def is_throttled(status=None, error=None):
+    """
+    :param status: response status code, None when the request raised
+    :param error: exception raised by the request
+    :return: True for 403, 429, 5xx, timeouts and connection errors,
+        False without either, e.g. for a cancelled request
+    """
+    if error is not None:
+        return True
+    return status is not None and (status in THROTTLE_STATUSES or status >= 500)
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header, delay seconds or an HTTP date
+    :return: seconds to wait, None when absent or unparseable
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AIMDLimit:
+    """
+    Additive increase, multiplicative decrease limit on requests in flight.
+    Grows by about one request per window of healthy responses, is cut by decrease on a throttle,
+    at most once per cooldown so a burst of errors from requests already in flight counts once.
+    :param initial: starting limit
+    :param minimum: lowest limit
+    :param maximum: highest limit
+    :param decrease: factor applied to the limit on a throttle
+    :param cooldown: seconds after a decrease during which further throttles do not decrease again
+    :param base_pause: pause after a throttle without Retry-After, doubled for consecutive throttles
+    :param max_pause: cap on that pause
+    """
+
+    def __init__(self, initial, minimum=1, maximum=64, decrease=0.5, cooldown=1.0, base_pause=1.0, max_pause=60.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.base_pause = base_pause
+        self.max_pause = max_pause
+        self.inflight = 0
+        self.paused_until = 0.0
+        self.throttle_streak = 0
+        self._last_decrease = float('-inf')
+
+    def wait_time(self, now):
+        """
+        :return: 0 when a request may start now, otherwise seconds until it might, None when only a release helps
+        """
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0 if self.inflight < int(self.limit) else None
+
+    def on_success(self):
+        self.throttle_streak = 0
+        self.limit = min(self.maximum, self.limit + 1 / max(self.limit, 1))
+
+    def on_throttle(self, now, retry_after=None):
+        self.throttle_streak += 1
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self._last_decrease = now
+        pause = retry_after if retry_after is not None \
+            else min(self.max_pause, self.base_pause * 2 ** (self.throttle_streak - 1))
+        self.paused_until = max(self.paused_until, now + pause)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency control shared by all fetchers, one limit for the site and one per proxy.
+    Usable from threads (acquire) and from an event loop (acquire_async), both followed by release.
+    :param initial: starting global limit
+    :param maximum: highest global limit, the fetcher's worker count should be at least this
+    :param per_proxy_initial: starting limit of each proxy
+    :param per_proxy_maximum: highest limit of each proxy
+    :param metrics: CrawlMetrics receiving the global limit and throttle counts
+    """
+
+    def __init__(self, initial=3, maximum=32, per_proxy_initial=2, per_proxy_maximum=8, metrics=None, **kwargs):
+        self.logger = logging.getLogger(__name__)
+        self.metrics = metrics
+        self.per_proxy_initial = per_proxy_initial
+        self.per_proxy_maximum = per_proxy_maximum
+        self._kwargs = kwargs
+        self._global = AIMDLimit(initial, maximum=maximum, **kwargs)
+        self._proxies = {}
+        self._condition = threading.Condition()
+
+    def _proxy_limit(self, proxy):
+        limit = self._proxies.get(proxy)
+        if limit is None:
+            limit = self._proxies[proxy] = AIMDLimit(self.per_proxy_initial, maximum=self.per_proxy_maximum,
+                                                     **self._kwargs)
+        return limit
+
+    def _try_acquire(self, choose, tries):
+        """
+        :return: (True, proxy, None) when a slot was taken, otherwise (False, None, seconds to wait or None)
+        """
+        now = time.monotonic()
+        wait = self._global.wait_time(now)
+        if wait != 0:
+            return False, None, wait
+        proxy_wait = None
+        # A throttled proxy should not hold up the others, so look at a few candidates before waiting
+        for _ in range(tries):
+            proxy = choose()
+            if proxy is None:
+                # Direct requests have no proxy of their own to spare, the global limit is the only one
+                self._global.inflight += 1
+                return True, None, None
+            limit = self._proxy_limit(proxy)
+            wait = limit.wait_time(now)
+            if wait == 0:
+                self._global.inflight += 1
+                limit.inflight += 1
+                return True, proxy, None
+            if wait is not None:
+                proxy_wait = wait if proxy_wait is None else min(proxy_wait, wait)
+        return False, None, proxy_wait
+
+    def acquire(self, choose, tries=5):
+        """
+        Blocks until the site and a proxy have room for another request
+        :param choose: callable returning a proxy, e.g. ProxyPool.choose
+        :return: the proxy to use, hand it back with release
+        """
+        with self._condition:
+            while True:
+                acquired, proxy, wait = self._try_acquire(choose, tries)
+                if acquired:
+                    return proxy
+                self._condition.wait(timeout=wait if wait is not None else 1.0)
+
+    async def acquire_async(self, choose, tries=5):
+        while True:
+            with self._condition:
+                acquired, proxy, wait = self._try_acquire(choose, tries)
+            if acquired:
+                return proxy
+            await asyncio.sleep(min(wait, 1.0) if wait is not None else 0.05)
+
+    def release(self, proxy, status=None, error=None, retry_after=None):
+        """
+        Frees the slot and adapts the limits to the outcome
+        :param proxy: proxy returned by acquire, None for a direct request
+        :param status: response status code, None when the request raised
+        :param error: exception raised by the request
+        :param retry_after: Retry-After header of the response
+        """
+        now = time.monotonic()
+        with self._condition:
+            limit = self._proxy_limit(proxy) if proxy is not None else None
+            self._global.inflight -= 1
+            if limit is not None:
+                limit.inflight -= 1
+            if not is_throttled(status, error):
+                self._global.on_success()
+                if limit is not None:
+                    limit.on_success()
+            else:
+                delay = parse_retry_after(retry_after)
+                if limit is not None:
+                    limit.on_throttle(now, delay)
+                # Proxy errors only say something about that proxy, throttling responses and direct errors
+                # are about the site
+                if error is None or limit is None:
+                    self._global.on_throttle(now, delay)
+                    if delay:
+                        self.logger.info(f"Site asked to retry after {delay:.0f}s, pausing all requests")
+            global_limit = self._global.limit
+            self._condition.notify_all()
+        if self.metrics is not None:
+            self.metrics.set_gauge('concurrency_limit', round(global_limit, 2))
+            if is_throttled(status, error):
+                self.metrics.inc('throttled', reason=type(error).__name__ if error is not None else status)
+
+    def snapshot(self):
+        """
+        :return: dict with the global limit, requests in flight and the limit of every proxy
+        """
+        with self._condition:
+            return {'limit': self._global.limit, 'inflight': self._global.inflight,
+                    'proxies': {proxy: limit.limit for proxy, limit in self._proxies.items()}}
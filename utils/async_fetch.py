@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+import httpx
+import lxml.html
+
+from utils import extract_yearly_data, http_archive, page_fingerprint
+from utils.adaptive_limit import AdaptiveConcurrency
+from utils.crawl_metrics import CrawlMetrics, PARSE_BUCKETS
+from utils.db_writer import WriterError
+from utils.proxy_pool import ProxyPool, httpx_proxy
+from utils.statement_variant import DEFAULT_VARIANT, changed_variant, other_variant_url, variant_of
+
+
+class TokenBucket:
+    """
+    Async token bucket, allows bursts of up to capacity requests and refills at rate tokens per second
+    :param rate: sustained requests per second
+    :param capacity: burst size, defaults to rate
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # Holding the lock while sleeping keeps waiters in FIFO order
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class HostRateLimiter:
+    """
+    Keeps one TokenBucket per host so each site is throttled independently
+    :param rate: requests per second allowed for every host
+    :param capacity: burst size per host
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+
+    async def acquire(self, url):
+        host = urlsplit(url).netloc
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(self.rate, self.capacity)
+        await bucket.acquire()
+
+
+def parse_page(content, known_hash=None):
+    """
+    CPU bound part of the crawl, kept module level so it can run in any executor
+    :param content: raw response body of a screener company page
+    :param known_hash: content_hash of the stored page, extraction is skipped when it matches
+    :return: page_hash, (col_headers, yearly_data, doubt) or None when unchanged, dict of step -> seconds
+    """
+    # The page is parsed once, the hash and the extraction both work on the same tree
+    start = time.perf_counter()
+    tree = lxml.html.fromstring(content)
+    timings = {'document': time.perf_counter() - start}
+    start = time.perf_counter()
+    page_hash = page_fingerprint.tree_hash(tree)
+    timings['hash'] = time.perf_counter() - start
+    if page_hash == known_hash:
+        return page_hash, None, timings
+    return page_hash, extract_yearly_data.extract_yearly_data_from_tree(tree, timings), timings
+
+
+def parse_executor(workers=None):
+    """
+    Process pool for parse_page, parsing is pure python and lxml work that threads would serialise on the GIL.
+    Workers are spawned rather than forked since the crawler already runs writer and heartbeat threads.
+    :param workers: processes, defaults to the CPU count
+    """
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+class AsyncFetchEngine:
+    """
+    Event loop based crawler for screener company pages.
+    Fetch workers feed a bounded parse queue, parse workers feed a bounded DB queue drained by one writer task.
+    :param writer: BatchWriter receiving soups and yearly fundamentals
+    :param user_agents: list of user agents picked at random per request
+    :param fingerprints: dict of stock_id -> PageFingerprint of the stored pages
+    :param variants: dict of stock_id -> statement variant the job urls were built for, the other one is the fallback
+    :param proxy_pool: ProxyPool routing each request, direct connections when None or empty
+    :param concurrency: requests in flight at once
+    :param rate: requests per second allowed per host
+    :param parse_workers: parallel parse jobs, defaults to the CPU count
+    :param queue_size: capacity of the parse and DB queues
+    :param timeout: request timeout in seconds
+    :param metrics: CrawlMetrics receiving request latencies, parse timings and queue depths
+    :param limiter: AdaptiveConcurrency deciding how many of the concurrency connections are used at a time
+    :param executor: process pool running parse_page, one of parse_workers processes is created per run when None
+    """
+
+    def __init__(self, writer, user_agents, fingerprints=None, variants=None, proxy_pool=None, concurrency=200, rate=3,
+                 parse_workers=None, queue_size=100, timeout=10, metrics=None, limiter=None, executor=None):
+        self.logger = logging.getLogger(__name__)
+        self.writer = writer
+        self.user_agents = user_agents
+        self.fingerprints = fingerprints or {}
+        self.variants = variants or {}
+        self.proxy_pool = proxy_pool if proxy_pool is not None else ProxyPool()
+        # httpx binds a proxy to a client, so keep one pooled client per proxy
+        self._clients = {}
+        self.concurrency = concurrency
+        self.limiter = HostRateLimiter(rate)
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.executor = executor
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else CrawlMetrics()
+        self.deadline = None
+        self.concurrency_limiter = limiter if limiter is not None \
+            else AdaptiveConcurrency(maximum=concurrency, metrics=self.metrics)
+
+    def run(self, jobs, deadline=None):
+        """
+        Crawls every (stock_id, url) job to completion, in the given order
+        :param jobs: iterable of (stock_id, consolidated url)
+        :param deadline: time.monotonic() after which queued jobs are dropped instead of fetched
+        :return: None
+        """
+        self.deadline = deadline
+        own_executor = self.executor is None
+        if own_executor:
+            self.executor = parse_executor(self.parse_workers)
+        try:
+            asyncio.run(self._run(list(jobs)))
+        finally:
+            if own_executor:
+                self.executor.shutdown()
+                self.executor = None
+
+    async def _run(self, jobs):
+        fetch_queue = asyncio.Queue()
+        parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        db_queue = asyncio.Queue(maxsize=self.queue_size)
+        for stock_id, url in jobs:
+            fetch_queue.put_nowait((stock_id, url))
+        print(f"Starting async crawl of {len(jobs)} urls with {self.concurrency} connections")
+
+        workers = []
+        try:
+            workers = [asyncio.create_task(self._fetch_worker(fetch_queue, parse_queue))
+                       for _ in range(min(self.concurrency, max(len(jobs), 1)))]
+            workers += [asyncio.create_task(self._parse_worker(fetch_queue, parse_queue, db_queue))
+                        for _ in range(self.parse_workers)]
+            workers.append(asyncio.create_task(self._db_worker(db_queue)))
+            workers.append(asyncio.create_task(self._monitor_queues(
+                {'fetch': fetch_queue, 'parse': parse_queue, 'db': db_queue})))
+            drained = asyncio.create_task(self._drain(fetch_queue, db_queue))
+            workers.append(drained)
+
+            # Workers only return by raising, e.g. a WriterError once the flusher stopped, which ends the crawl
+            # instead of waiting on jobs nobody takes anymore. The jobs left over stay leased in crawl_job
+            done, _ = await asyncio.wait(workers, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await asyncio.gather(*(client.aclose() for client in self._clients.values()))
+            self._clients.clear()
+        print("Async crawl completed")
+
+    @staticmethod
+    async def _drain(fetch_queue, db_queue):
+        # Fallback urls are queued before the job they replace is finished, so once fetch_queue is joined
+        # nothing is left to fetch or parse
+        await fetch_queue.join()
+        await db_queue.join()
+
+    def _client(self, proxy):
+        client = self._clients.get(proxy)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+            archive = http_archive.active()
+            if archive is not None:
+                transport = http_archive.ArchiveTransport(
+                    archive, httpx.AsyncHTTPTransport(proxy=httpx_proxy(proxy), limits=limits))
+                client = httpx.AsyncClient(transport=transport, timeout=self.timeout, follow_redirects=True)
+            else:
+                client = httpx.AsyncClient(proxy=httpx_proxy(proxy), timeout=self.timeout, limits=limits,
+                                           follow_redirects=True)
+            self._clients[proxy] = client
+        return client
+
+    async def _monitor_queues(self, queues, interval=1.0):
+        while True:
+            for name, queue in queues.items():
+                self.metrics.set_gauge('queue_depth', queue.qsize(), queue=name)
+            await asyncio.sleep(interval)
+
+    async def _get(self, url, headers):
+        proxy = await self.concurrency_limiter.acquire_async(self.proxy_pool.choose)
+        start = time.monotonic()
+        status = error = retry_after = None
+        try:
+            response = await self._client(proxy).get(url, headers=headers)
+            status, retry_after = response.status_code, response.headers.get('Retry-After')
+        except Exception as e:
+            error = e
+            self.proxy_pool.report_failure(proxy)
+            self.metrics.inc('fetch_errors', proxy=proxy or 'direct', error=type(e).__name__)
+            raise
+        finally:
+            # Exactly one release per acquire, whatever the request raised, even when it was cancelled
+            self.concurrency_limiter.release(proxy, status, error=error, retry_after=retry_after)
+        elapsed = time.monotonic() - start
+        self.metrics.observe('fetch_seconds', elapsed, proxy=proxy or 'direct')
+        self.metrics.inc('fetch_responses', status=response.status_code)
+        if response.status_code in (403, 407, 429) or response.status_code >= 500:
+            self.proxy_pool.report_failure(proxy)
+        else:
+            self.proxy_pool.report_success(proxy, elapsed)
+        return response
+
+    async def _fetch_worker(self, fetch_queue, parse_queue):
+        while True:
+            stock_id, url = await fetch_queue.get()
+            # A job handed to parsing stays unfinished in fetch_queue until the parse worker is done with it
+            handed_off = False
+            try:
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    # Left running in crawl_job, the next run resumes it
+                    continue
+                await self.limiter.acquire(url)
+                headers = {'User-Agent': random.choice(self.user_agents)}
+                headers.update(page_fingerprint.conditional_headers(self.fingerprints.get(stock_id)))
+                print(f'Processing: {stock_id}->{url}')
+                response = await self._get(url, headers)
+                if response.status_code == 304:
+                    print(f'Unchanged since last fetch: {stock_id}')
+                    self.metrics.inc('pages_unchanged', check='not_modified')
+                    # The variant may never have been saved when the page was stored
+                    await asyncio.to_thread(self.writer.add_page, stock_id,
+                                            page_fingerprint.from_response(response, None),
+                                            variant=changed_variant(url, self.variants.get(stock_id)))
+                elif response.status_code == 200 and response.content:
+                    await parse_queue.put((stock_id, url, response))
+                    handed_off = True
+                else:
+                    print(f"Failed to fetch url {url} with status code {response.status_code}")
+                    self.metrics.inc('pages_failed', stage='fetch')
+                    await asyncio.to_thread(self.writer.add_job_failed, stock_id,
+                                            f'status code {response.status_code}')
+            except httpx.HTTPError as e:
+                print(f"Request failed for {url}: {e}")
+                self.metrics.inc('pages_failed', stage='fetch')
+                await asyncio.to_thread(self.writer.add_job_failed, stock_id, f'{type(e).__name__}: {e}')
+            except Exception as e:
+                # Keep the worker alive for the next stock, a dead worker would leave its job unfinished
+                self.logger.error(f"Could not fetch {stock_id}->{url}: {e}", exc_info=True)
+                self.metrics.inc('pages_failed', stage='fetch')
+                await asyncio.to_thread(self.writer.add_job_failed, stock_id, f'{type(e).__name__}: {e}')
+            finally:
+                if not handed_off:
+                    fetch_queue.task_done()
+
+    async def _parse_worker(self, fetch_queue, parse_queue, db_queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            stock_id, url, response = await parse_queue.get()
+            try:
+                stored = self.fingerprints.get(stock_id)
+                page_hash, parsed, timings = await loop.run_in_executor(self.executor, parse_page, response.content,
+                                                                        stored and stored.content_hash)
+                for step, seconds in timings.items():
+                    self.metrics.observe('parse_seconds', seconds, PARSE_BUCKETS, step=step)
+                fingerprint = page_fingerprint.from_response(response, page_hash)
+                if parsed is None:
+                    print(f'Unchanged since last fetch: {stock_id}')
+                    self.metrics.inc('pages_unchanged', check='content_hash')
+                    await db_queue.put((stock_id, url, None, fingerprint, None, None))
+                    continue
+                col_headers, yearly_data, doubt = parsed
+                if doubt:
+                    if variant_of(url) == self.variants.get(stock_id, DEFAULT_VARIANT):
+                        fallback_url = other_variant_url(url)
+                        print(f"Processing {variant_of(fallback_url).title()}: {stock_id}->{fallback_url}")
+                        self.metrics.inc('retries', reason=variant_of(fallback_url))
+                        fetch_queue.put_nowait((stock_id, fallback_url))
+                    else:
+                        print(f"soup is still doubtful {url}\n")
+                        self.metrics.inc('pages_failed', stage='doubtful')
+                        await asyncio.to_thread(self.writer.add_job_failed, stock_id, 'doubtful yearly data')
+                    continue
+                await db_queue.put((stock_id, url, response.content, fingerprint, col_headers, yearly_data))
+            except Exception as e:
+                self.logger.error(f"Could not parse {stock_id}->{url}: {e}", exc_info=True)
+                self.metrics.inc('pages_failed', stage='parse')
+                await asyncio.to_thread(self.writer.add_job_failed, stock_id, f'{type(e).__name__}: {e}')
+            finally:
+                parse_queue.task_done()
+                fetch_queue.task_done()
+
+    async def _db_worker(self, db_queue):
+        while True:
+            stock_id, url, content, fingerprint, col_headers, yearly_data = await db_queue.get()
+            try:
+                # BatchWriter may block for backpressure, keep that off the event loop
+                await asyncio.to_thread(self.writer.add_page, stock_id, fingerprint, content, col_headers, yearly_data,
+                                        variant=changed_variant(url, self.variants.get(stock_id)))
+                if content is not None:
+                    self.metrics.inc('pages_parsed')
+            except WriterError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Could not queue writes for {stock_id}: {e}", exc_info=True)
+            finally:
+                db_queue.task_done()
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, one set sized for requests and one for CPU work and DB flushes
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PARSE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Histogram:
+    """
+    Cumulative bucket counts in the Prometheus sense, cheap enough to observe every request
+    :param buckets: ascending upper bounds
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        """
+        :return: upper bound of the bucket holding the q-th quantile, max beyond the last bucket
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': round(self.max, 6),
+            'buckets': dict(zip(map(str, self.buckets), self.counts)),
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _label_text(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+class CrawlMetrics:
+    """
+    Thread safe counters, gauges and histograms for one crawl run, labelled by e.g. proxy, section or table.
+    Summarised as json at the end of the run and optionally written in the Prometheus text format.
+    :param prefix: prefix of every metric name in the Prometheus output
+    """
+
+    def __init__(self, prefix='stonks'):
+        self.logger = logging.getLogger(__name__)
+        self.prefix = prefix
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        # The peak is kept next to the last value, a queue that was full mid run matters more than its final depth
+        key = _key(name, labels)
+        with self._lock:
+            _, peak = self._gauges.get(key, (value, value))
+            self._gauges[key] = (value, max(peak, value))
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, buckets=LATENCY_BUCKETS, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, buckets, **labels)
+
+    @staticmethod
+    def _name(name, labels):
+        return name + ''.join(f'[{key}={value}]' for key, value in labels)
+
+    def summary(self):
+        """
+        :return: json serialisable dict of every metric, counters also as a rate per second of the run
+        """
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            counters = {self._name(*key): value for key, value in sorted(self._counters.items())}
+            gauges = {self._name(*key): {'last': last, 'max': peak} for key, (last, peak) in sorted(self._gauges.items())}
+            histograms = {self._name(*key): histogram.to_dict() for key, histogram in sorted(self._histograms.items())}
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'counters': counters,
+            'rates_per_second': {name: round(value / elapsed, 3) for name, value in counters.items()} if elapsed else {},
+            'gauges': gauges,
+            'histograms': histograms,
+        }
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            typed = set()
+
+            def declare(name, kind):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} {kind}')
+
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = f'{self.prefix}_{name}_total'
+                declare(metric, 'counter')
+                lines.append(f'{metric}{_label_text(labels)} {value}')
+            for suffix, position in (('', 0), ('_max', 1)):
+                for (name, labels), values in sorted(self._gauges.items()):
+                    metric = f'{self.prefix}_{name}{suffix}'
+                    declare(metric, 'gauge')
+                    lines.append(f'{metric}{_label_text(labels)} {values[position]}')
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric = f'{self.prefix}_{name}'
+                declare(metric, 'histogram')
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{metric}_bucket{_label_text(labels, [("le", bound)])} {count}')
+                lines.append(f'{metric}_bucket{_label_text(labels, [("le", "+Inf")])} {histogram.count}')
+                lines.append(f'{metric}_sum{_label_text(labels)} {histogram.sum}')
+                lines.append(f'{metric}_count{_label_text(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def _write(self, path, text):
+        # Written atomically so a node exporter textfile collector never reads half a file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def write_json(self, path):
+        self._write(path, json.dumps(self.summary(), indent=2))
+        self.logger.info(f"Crawl metrics written to {path}")
+
+    def write_prometheus(self, path):
+        self._write(path, self.prometheus_text())
+        self.logger.info(f"Prometheus metrics written to {path}")
@@ -0,0 +1,86 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from psycopg2 import Error, pool
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of Postgres connections shared by DBUtils and all worker threads
+    :param db_params: keyword arguments passed to psycopg2.connect
+    :param min_size: connections opened upfront and kept alive
+    :param max_size: hard cap on connections open at once, callers block beyond this
+    :param timeout: seconds to wait for a free connection before giving up
+    """
+
+    def __init__(self, db_params, min_size=1, max_size=10, timeout=30):
+        self.logger = logging.getLogger(__name__)
+        self.timeout = timeout
+        self.max_size = max_size
+        # ThreadedConnectionPool raises instead of waiting when exhausted, the semaphore makes callers queue up
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._pool = pool.ThreadedConnectionPool(min_size, max_size, **db_params)
+        self.logger.debug(f"Connection pool created min:{min_size} max:{max_size}")
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (Exception, Error):
+            return False
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise pool.PoolError(f"No connection available within {self.timeout} seconds")
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                self.logger.warning("Discarding broken connection from pool")
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a healthy connection, commits on success and rolls back on error
+        :return: psycopg2 connection
+        """
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except (Exception, Error):
+                broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def close(self):
+        if not self._pool.closed:
+            self._pool.closeall()
+            self.logger.debug("Closed all pooled connections")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,236 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from utils.crawl_metrics import CrawlMetrics
+
+
+class WriterError(RuntimeError):
+    """
+    Raised to producers once the BatchWriter flusher thread has stopped, chained to the exception that stopped it
+    """
+
+
+class DryRunDB:
+    """
+    Stands in for DBUtils when nothing may be written, e.g. replaying an http archive.
+    The writes only report how many rows they would have written, get_* reads go to db_utils when given.
+    :param db_utils: DBUtils instance serving the reads
+    """
+
+    def __init__(self, db_utils=None):
+        self.db_utils = db_utils
+
+    def __getattr__(self, name):
+        if name.startswith('get_') and self.db_utils is not None:
+            return getattr(self.db_utils, name)
+        raise AttributeError(name)
+
+    def upsert_soup_batch(self, rows):
+        return len(rows)
+
+    def mark_soup_unchanged_batch(self, rows):
+        return len(rows)
+
+    def upsert_yearly_fundamentals_batch(self, col_headers, rows):
+        return len(rows)
+
+    def update_statement_variants(self, rows):
+        return len(rows)
+
+    def update_stock_sector_batch(self, rows):
+        return len(rows)
+
+    def update_screener_urls(self, rows):
+        return len(rows)
+
+    def invalidate_screener_urls(self, index_id, symbols=None):
+        pass
+
+
+class BatchWriter:
+    """
+    Buffers raw soups, yearly fundamentals and statement variants from many stocks and writes them with set based
+    upserts from a background thread, so fetch threads only append to memory instead of waiting on commits
+    :param db_utils: DBUtils instance used for the batch upserts
+    :param max_rows: buffered rows that trigger a flush
+    :param flush_interval: seconds after which a non-empty buffer is flushed anyway
+    :param max_pending: buffered rows beyond which add calls wait for the flusher to catch up
+    :param metrics: CrawlMetrics receiving flush timings, rows written and the buffer depth
+    :param job_queue: JobQueue whose job outcomes are recorded once the rows they produced are written
+    """
+
+    def __init__(self, db_utils, max_rows=500, flush_interval=5.0, max_pending=None, metrics=None, job_queue=None):
+        self.logger = logging.getLogger(__name__)
+        self.db_utils = db_utils
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending or max_rows * 10
+        self.metrics = metrics if metrics is not None else CrawlMetrics()
+        self.job_queue = job_queue
+        self._soups = []
+        self._unchanged = []
+        # yearly_financial_data rows grouped by their column list, one statement per group
+        self._fundamentals = defaultdict(list)
+        self._variants = []
+        self._jobs_done = []
+        self._jobs_failed = []
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        # Set when the flusher thread died, producers fail fast instead of waiting on it forever
+        self._error = None
+        self._last_flush = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="BatchWriter", daemon=True)
+        self._thread.start()
+
+    def add_yearly_fundamentals(self, stock_id, col_headers, yearly_data):
+        rows = [[stock_id, year, *data] for year, data in yearly_data.items()]
+        self._add(lambda: self._fundamentals[tuple(col_headers)].extend(rows), len(rows))
+
+    def add_page(self, stock_id, fingerprint, soup=None, col_headers=None, yearly_data=None, variant=None):
+        """
+        Buffers everything one crawled page produced together with its done marker, in one step so the rows and
+        the job outcome always land in the same flush and a job is never done when its rows could not be written
+        :param stock_id: stock of the page
+        :param fingerprint: PageFingerprint of the response
+        :param soup: raw page, None when it is unchanged since the stored copy
+        :param col_headers: column headers of yearly_data
+        :param yearly_data: dict of year -> values, as extracted from soup
+        :param variant: statement variant to remember for the stock, None to keep the stored one
+        """
+        rows = [[stock_id, year, *data] for year, data in yearly_data.items()] if soup is not None else []
+
+        def append():
+            if soup is None:
+                self._unchanged.append((stock_id, fingerprint))
+            else:
+                self._soups.append((stock_id, soup, fingerprint))
+                self._fundamentals[tuple(col_headers)].extend(rows)
+            if variant is not None:
+                self._variants.append((variant, stock_id))
+            if self.job_queue is not None:
+                self._jobs_done.append(stock_id)
+
+        self._add(append, 1 + len(rows) + (variant is not None))
+
+    def add_job_failed(self, stock_id, error):
+        if self.job_queue is not None:
+            self._add(lambda: self._jobs_failed.append((stock_id, error)), 0)
+
+    def _add(self, append, count):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BatchWriter is closed")
+            self.check()
+            if self._pending >= self.max_pending:
+                self.metrics.inc('writer_backpressure_waits')
+            while self._pending >= self.max_pending:
+                self._condition.wait(timeout=self.flush_interval)
+                self.check()
+            append()
+            self._pending += count
+            self.metrics.set_gauge('queue_depth', self._pending, queue='writer')
+            if self._pending >= self.max_rows:
+                self._condition.notify_all()
+
+    def check(self):
+        """
+        Raises WriterError when the flusher thread stopped, nothing added from then on would be written
+        """
+        if self._error is not None or (not self._closed and not self._thread.is_alive()):
+            raise WriterError("BatchWriter flusher thread stopped") from self._error
+
+    def _take(self):
+        with self._condition:
+            soups, unchanged, fundamentals = self._soups, self._unchanged, self._fundamentals
+            variants, jobs_done, jobs_failed = self._variants, self._jobs_done, self._jobs_failed
+            self._soups, self._unchanged, self._fundamentals, self._variants = [], [], defaultdict(list), []
+            self._jobs_done, self._jobs_failed = [], []
+            self._pending = 0
+            self.metrics.set_gauge('queue_depth', 0, queue='writer')
+            self._last_flush = time.monotonic()
+            self._condition.notify_all()
+        return soups, unchanged, fundamentals, variants, jobs_done, jobs_failed
+
+    def flush(self):
+        """
+        Writes everything buffered so far, safe to call from any thread
+        :return: number of rows written
+        """
+        with self._flush_lock:
+            soups, unchanged, fundamentals, variants, jobs_done, jobs_failed = self._take()
+            written = 0
+            # Stocks whose rows could not be written, their jobs are failed instead of done
+            unwritten = set()
+            if soups:
+                count = self._write('raw_soup_base', self.db_utils.upsert_soup_batch, soups)
+                written += count
+                if not count:
+                    unwritten.update(row[0] for row in soups)
+            if unchanged:
+                count = self._write('raw_soup_base_unchanged', self.db_utils.mark_soup_unchanged_batch, unchanged)
+                written += count
+                if not count:
+                    unwritten.update(row[0] for row in unchanged)
+            for col_headers, rows in fundamentals.items():
+                count = self._write('yearly_financial_data', self.db_utils.upsert_yearly_fundamentals_batch,
+                                    list(col_headers), rows)
+                written += count
+                if not count:
+                    unwritten.update(row[0] for row in rows)
+            if variants:
+                # Only a hint for the next fetch, a failed write just costs one fallback request later
+                written += self._write('stock_base_variant', self.db_utils.update_statement_variants, variants)
+            if self.job_queue is not None and (jobs_done or jobs_failed):
+                self.job_queue.done([stock_id for stock_id in jobs_done if stock_id not in unwritten])
+                self.job_queue.failed(jobs_failed + [(stock_id, 'database write failed')
+                                                     for stock_id in jobs_done if stock_id in unwritten])
+            if written:
+                self.logger.debug(f"Flushed {written} rows")
+            return written
+
+    def _write(self, table, upsert, *args):
+        with self.metrics.timer('db_flush_seconds', table=table):
+            written = upsert(*args)
+        self.metrics.inc('rows_written', written, table=table)
+        if not written:
+            self.metrics.inc('db_failures', table=table)
+        return written
+
+    def _due(self):
+        if self._pending >= self.max_rows:
+            return True
+        buffered = self._pending > 0 or self._jobs_done or self._jobs_failed
+        return buffered and time.monotonic() - self._last_flush >= self.flush_interval
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed and not self._due():
+                        self._condition.wait(timeout=self.flush_interval)
+                    closed = self._closed
+                self.flush()
+                if closed:
+                    return
+        except Exception as err:
+            self.logger.error(f"BatchWriter flusher stopped: {err}", exc_info=True)
+            with self._condition:
+                self._error = err
+                self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,112 @@
+import numpy as np
+
+# Every function works on arrays whose last axis is the year axis, e.g. FundamentalsPanel.metric() (stocks x years),
+# so the whole universe is computed with a few array operations. Undefined results are NaN.
+
+
+def safe_divide(numerator, denominator):
+    """
+    :return: numerator / denominator, NaN where the denominator is 0 or either side is missing
+    """
+    numerator, denominator = np.broadcast_arrays(np.asarray(numerator, dtype=np.float64),
+                                                 np.asarray(denominator, dtype=np.float64))
+    out = np.full(numerator.shape, np.nan)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def _shift(values, periods):
+    # values of `periods` years earlier, NaN for the first years
+    shifted = np.full(values.shape, np.nan)
+    if periods < values.shape[-1]:
+        shifted[..., periods:] = values[..., :-periods]
+    return shifted
+
+
+def growth(values, periods=1):
+    """
+    Year on year growth rate, NaN when the base year is not positive
+    :param values: array with years on the last axis
+    :param periods: years between the compared values
+    :return: array of the same shape, as a fraction
+    """
+    values = np.asarray(values, dtype=np.float64)
+    base = _shift(values, periods)
+    return np.where(base > 0, safe_divide(values, base) - 1, np.nan)
+
+
+def cagr(values, years):
+    """
+    Compound annual growth rate over the trailing window, NaN when either end is missing or not positive
+    :param values: array with years on the last axis
+    :param years: length of the window in years
+    :return: array of the same shape, as a fraction
+    """
+    values = np.asarray(values, dtype=np.float64)
+    base = _shift(values, years)
+    valid = (base > 0) & (values > 0)
+    ratio = np.where(valid, safe_divide(values, base), np.nan)
+    return np.power(ratio, 1.0 / years) - 1
+
+
+def margin(numerator, denominator):
+    """
+    :return: numerator as a percentage of denominator, e.g. margin(Net_Profit, Sales)
+    """
+    return safe_divide(numerator, denominator) * 100
+
+
+def trend(values, window=None):
+    """
+    Least squares slope per year over the trailing window, missing years are left out of the fit
+    :param values: array with years on the last axis
+    :param window: trailing years to fit, all years by default
+    :return: array with the year axis removed, NaN with fewer than two points
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if window is not None:
+        values = values[..., -window:]
+    present = ~np.isnan(values)
+    x = np.broadcast_to(np.arange(values.shape[-1], dtype=np.float64), values.shape)
+    count = present.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(present, x, 0).sum(axis=-1) / count
+        y_mean = np.where(present, values, 0).sum(axis=-1) / count
+        dx = np.where(present, x - x_mean[..., None], 0)
+        dy = np.where(present, values - y_mean[..., None], 0)
+        slope = (dx * dy).sum(axis=-1) / (dx * dx).sum(axis=-1)
+    return np.where(count >= 2, slope, np.nan)
+
+
+def return_on_equity(net_profit, equity_capital, reserves):
+    """
+    :return: net profit as a percentage of shareholders' funds, NaN when the funds are not positive
+    """
+    equity = np.asarray(equity_capital, dtype=np.float64) + np.asarray(reserves, dtype=np.float64)
+    return np.where(equity > 0, margin(net_profit, equity), np.nan)
+
+
+def derived_metrics(panel, cagr_years=(3, 5, 10), trend_window=5):
+    """
+    Standard screening metrics for every stock of a FundamentalsPanel in one go
+    :param panel: FundamentalsPanel
+    :param cagr_years: windows for the sales and profit CAGRs
+    :param trend_window: trailing years used for the ROE and margin trends
+    :return: dict of name -> stocks x years array, names ending in _trend are per stock arrays
+    """
+    sales = panel.metric('Sales')
+    net_profit = panel.metric('Net_Profit')
+    operating_profit = panel.metric('Operating_Profit')
+    metrics = {
+        'sales_growth': growth(sales),
+        'profit_growth': growth(net_profit),
+        'operating_margin': margin(operating_profit, sales),
+        'net_margin': margin(net_profit, sales),
+        'roe': return_on_equity(net_profit, panel.metric('Equity_Capital'), panel.metric('Reserves')),
+    }
+    for years in cagr_years:
+        metrics[f'sales_cagr_{years}y'] = cagr(sales, years)
+        metrics[f'profit_cagr_{years}y'] = cagr(net_profit, years)
+    metrics['roe_trend'] = trend(metrics['roe'], trend_window)
+    metrics['net_margin_trend'] = trend(metrics['net_margin'], trend_window)
+    return metrics
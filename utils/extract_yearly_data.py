@@ -1,12 +1,22 @@
 import sys
+import time
 
 from bs4 import BeautifulSoup
 from datetime import datetime
+import lxml.html
+from lxml import etree
+
+# Yearly Sections
+YEARLY_SECTIONS = {
+    'Profit Loss': ('profit-loss', None),
+    'Balanced Sheet': ('balance-sheet', None),
+    'Cash Flow': ('cash-flow', None),
+    'Ratios': ('ratios', None),
+    'Shareholding Pattern Data': ('shareholding', 'yearly-shp')
+}
 
-from utils.stockload import DBUtils
 
 def extract_section_data(soup, section_id, data_tab_id=None):
-    current_year = datetime.now().year
     try:
         section = soup.find('section', id=section_id)
     except TypeError as e:
@@ -25,10 +35,23 @@ def extract_section_data(soup, section_id, data_tab_id=None):
     if not table:
         raise ValueError(f"Table not found in section with id '{section_id}' and tab '{data_tab_id}'.")
 
+    header_texts = [header.get_text(strip=True) for header in table.find('thead').find_all('th')]
+    row_texts = [[cell.get_text(strip=True) for cell in row.find_all('td')]
+                 for row in table.find('tbody').find_all('tr')]
+    return build_section_data(header_texts, row_texts)
+
+
+def build_section_data(header_texts, row_texts):
+    """
+    Parser independent part of the section extraction, shared by the BeautifulSoup and lxml paths
+    :param header_texts: stripped text of every th in the table head
+    :param row_texts: stripped text of every td, per row of the table body
+    :return: row_header, transposed_data, doubt
+    """
+    current_year = datetime.now().year
     headers = []
     ttm_flag = False
-    for header in table.find('thead').find_all('th'):
-        header_text = header.get_text(strip=True)
+    for header_text in header_texts:
         if header_text == '':
             continue
         header_number = header_text.strip().split(' ')[-1]
@@ -48,9 +71,8 @@ def extract_section_data(soup, section_id, data_tab_id=None):
 
     rows = []
     row_header = []
-    for row in table.find('tbody').find_all('tr'):
-        cells = row.find_all('td')
-        row_data = [cell.get_text(strip=True).replace('+', '').replace('%', '').replace(',', '') for cell in cells]
+    for cells in row_texts:
+        row_data = [cell.replace('+', '').replace('%', '').replace(',', '') for cell in cells]
         temp = [float(value) if value != '' else 0 for value in row_data[1:]]
         rows.append(temp)
         if row_data[0] != '':
@@ -72,27 +94,122 @@ def extract_section_data(soup, section_id, data_tab_id=None):
     return row_header, transposed_data, doubt
 
 
+# Precompiled lookups for the lxml path, class matching follows BeautifulSoup's class_ token semantics
+_DATA_TABLE = etree.XPath(".//table[contains(concat(' ', normalize-space(@class), ' '), ' data-table ')]")
+_TAB = etree.XPath(".//div[@id=$tab_id]")
+_THEAD = etree.XPath(".//thead")
+_TBODY = etree.XPath(".//tbody")
+_TH = etree.XPath(".//th")
+_TR = etree.XPath(".//tr")
+_TD = etree.XPath(".//td")
+# text() skips comments, matching get_text
+_TEXT = etree.XPath(".//text()")
+
+
+def _first(element, xpath, **kwargs):
+    if element is None:
+        return None
+    found = xpath(element, **kwargs)
+    return found[0] if found else None
+
+
+def _stripped_text(element):
+    return ''.join(text.strip() for text in _TEXT(element))
+
+
+def extract_section_data_lxml(section, section_id, data_tab_id=None):
+    """
+    lxml counterpart of extract_section_data working on an already located section element
+    :param section: lxml element of the section, None when missing
+    :param section_id: id of the section, used in error messages
+    :param data_tab_id: id of the div holding the table inside the section
+    :return: row_header, transposed_data, doubt
+    """
+    if section is None:
+        raise ValueError(f"Section with id '{section_id}' not found in the HTML content.")
+
+    if data_tab_id:
+        tab = _first(section, _TAB, tab_id=data_tab_id)
+        if tab is None:
+            raise ValueError(f"Tab with id '{data_tab_id}' not found in section with id '{section_id}'.")
+        table = _first(tab, _DATA_TABLE)
+    else:
+        table = _first(section, _DATA_TABLE)
+
+    if table is None:
+        raise ValueError(f"Table not found in section with id '{section_id}' and tab '{data_tab_id}'.")
+
+    header_texts = [_stripped_text(header) for header in _TH(_first(table, _THEAD))]
+    row_texts = [[_stripped_text(cell) for cell in _TD(row)] for row in _TR(_first(table, _TBODY))]
+    return build_section_data(header_texts, row_texts)
+
+
+def extract_yearly_data_from_html(content, timings=None):
+    """
+    Fast path for extract_yearly_data_from_soup, parses with lxml directly and finds all sections in one pass
+    :param content: raw page as bytes or str
+    :param timings: optional dict filled with seconds spent on the html parse ('document') and on each section
+    :return: col_headers, yearly_data, doubt
+    """
+    start = time.perf_counter()
+    tree = lxml.html.fromstring(content)
+    if timings is not None:
+        timings['document'] = time.perf_counter() - start
+    return extract_yearly_data_from_tree(tree, timings)
+
+
+def extract_yearly_data_from_tree(tree, timings=None):
+    """
+    extract_yearly_data_from_html for a page already parsed with lxml.html
+    :param tree: root element of the page
+    :param timings: optional dict filled with seconds spent finding the sections ('sections') and on each section
+    :return: col_headers, yearly_data, doubt
+    """
+    start = time.perf_counter()
+    wanted = {section_id for section_id, _ in YEARLY_SECTIONS.values()}
+    found = {}
+    for section in tree.iter('section'):
+        section_id = section.get('id')
+        if section_id in wanted and section_id not in found:
+            found[section_id] = section
+            if len(found) == len(wanted):
+                break
+    if timings is not None:
+        timings['sections'] = time.perf_counter() - start
+
+    def section_results():
+        for section, (section_id, data_tab_id) in YEARLY_SECTIONS.items():
+            section_start = time.perf_counter()
+            result = extract_section_data_lxml(found.get(section_id), section_id, data_tab_id)
+            if timings is not None:
+                timings[section_id] = time.perf_counter() - section_start
+            yield section, result
+
+    return combine_sections(section_results())
+
+
 def extract_yearly_data_from_soup(html, parse=False):
     if parse:
         soup = BeautifulSoup(html, "lxml")
     else:
         soup = html
-    # Yearly Sections
-    sections = {
-        'Profit Loss': ('profit-loss', None),
-        'Balanced Sheet': ('balance-sheet', None),
-        'Cash Flow': ('cash-flow', None),
-        'Ratios': ('ratios', None),
-        'Shareholding Pattern Data': ('shareholding', 'yearly-shp')
-    }
+    section_results = ((section, extract_section_data(soup, *args)) for section, args in YEARLY_SECTIONS.items())
+    return combine_sections(section_results)
+
 
+def combine_sections(section_results):
+    """
+    Merges per section results into one row of values per year
+    :param section_results: iterable of (section name, (headers, data, doubt)) in YEARLY_SECTIONS order,
+        consumed lazily so sections after a doubtful one are never extracted
+    :return: col_headers, yearly_data, doubt
+    """
     section_data = dict()
     years = set()
     col_headers = []
     yearly_data = dict()
     doubt_list = []
-    for section, args in sections.items():
-        headers, data, doubt = extract_section_data(soup, *args)
+    for section, (headers, data, doubt) in section_results:
         if section != 'Shareholding Pattern Data' and doubt:
             return None, None, doubt
         elif section == 'Shareholding Pattern Data':
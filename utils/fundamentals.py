@@ -0,0 +1,124 @@
+from collections import namedtuple
+
+import numpy as np
+
+# One stock's yearly fundamentals, values is a float64 array of shape (len(years), len(metrics)), NaN when missing
+StockFundamentals = namedtuple('StockFundamentals', ['stock_id', 'years', 'metrics', 'values'])
+
+
+def from_yearly_data(stock_id, col_headers, yearly_data):
+    """
+    Columnar form of the output of extract_yearly_data_from_soup / extract_yearly_data_from_html
+    :param stock_id: stock_id from stock_base
+    :param col_headers: metric names, a repeated name keeps its first column
+    :param yearly_data: dict of year -> list of values in col_headers order
+    :return: StockFundamentals with years in ascending order
+    """
+    years = np.array(sorted(yearly_data), dtype=np.int64)
+    values = np.full((len(years), len(col_headers)), np.nan)
+    for i, year in enumerate(years):
+        row = yearly_data[year]
+        values[i, :len(row)] = row
+    _, first = np.unique(np.array(col_headers, dtype=object), return_index=True)
+    order = np.sort(first)
+    return StockFundamentals(stock_id, years, tuple(col_headers[i] for i in order), values[:, order])
+
+
+class FundamentalsPanel:
+    """
+    Fundamentals of many stocks as one stocks x years x metrics float64 tensor, NaN where a stock lacks a year or metric
+    :param stock_ids: array of stock ids, one per row of values
+    :param years: ascending array of years
+    :param metrics: tuple of metric names
+    :param values: array of shape (len(stock_ids), len(years), len(metrics))
+    """
+
+    def __init__(self, stock_ids, years, metrics, values):
+        self.stock_ids = np.asarray(stock_ids)
+        self.years = np.asarray(years)
+        self.metrics = tuple(metrics)
+        self.values = values
+        # Looked up case insensitively, Postgres hands back the unquoted column names lowercased
+        self._metric_index = {}
+        for i, metric in enumerate(self.metrics):
+            self._metric_index.setdefault(metric.lower(), i)
+        self._stock_index = {stock_id: i for i, stock_id in enumerate(self.stock_ids.tolist())}
+
+    @classmethod
+    def stack(cls, fundamentals, metrics=None):
+        """
+        Aligns per stock fundamentals on the union of their years
+        :param fundamentals: iterable of StockFundamentals
+        :param metrics: metric names to keep, by default every metric in order of first appearance
+        :return: FundamentalsPanel
+        """
+        fundamentals = list(fundamentals)
+        if metrics is None:
+            metrics = list(dict.fromkeys(metric for f in fundamentals for metric in f.metrics))
+        metric_index = {metric: i for i, metric in enumerate(metrics)}
+        years = np.unique(np.concatenate([f.years for f in fundamentals])) if fundamentals \
+            else np.empty(0, dtype=np.int64)
+        values = np.full((len(fundamentals), len(years), len(metrics)), np.nan)
+        for i, f in enumerate(fundamentals):
+            source = [j for j, metric in enumerate(f.metrics) if metric in metric_index]
+            target = [metric_index[f.metrics[j]] for j in source]
+            rows = np.searchsorted(years, f.years)
+            values[i, rows[:, None], target] = f.values[:, source]
+        return cls([f.stock_id for f in fundamentals], years, metrics, values)
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        """
+        Builds the panel straight from yearly_financial_data rows, without a per stock detour
+        :param columns: column names, must contain stock_id and year
+        :param rows: sequence of tuples in columns order
+        :return: FundamentalsPanel
+        """
+        columns = list(columns)
+        stock_col, year_col = columns.index('stock_id'), columns.index('year')
+        metric_cols = [i for i, column in enumerate(columns) if i not in (stock_col, year_col)]
+        data = np.array(rows, dtype=object).reshape(len(rows), len(columns))
+        stock_ids, stock_pos = np.unique(data[:, stock_col].astype(np.int64), return_inverse=True)
+        years, year_pos = np.unique(data[:, year_col].astype(np.int64), return_inverse=True)
+        # None from NULL columns becomes NaN
+        metric_values = np.array(data[:, metric_cols], dtype=np.float64) if metric_cols \
+            else np.empty((len(rows), 0))
+        values = np.full((len(stock_ids), len(years), len(metric_cols)), np.nan)
+        values[stock_pos, year_pos] = metric_values
+        return cls(stock_ids, years, [columns[i] for i in metric_cols], values)
+
+    @classmethod
+    def from_db(cls, db_utils, index_id):
+        """
+        :param db_utils: DBUtils instance
+        :param index_id: index_id from index_base
+        :return: FundamentalsPanel of every stock of the index, None when the fetch failed
+        """
+        result = db_utils.get_yearly_fundamentals(index_id)
+        if result is None:
+            return None
+        return cls.from_rows(*result)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __contains__(self, metric):
+        return metric.lower() in self._metric_index
+
+    def metric(self, name):
+        """
+        :param name: metric name in any case, e.g. Sales or sales
+        :return: stocks x years array of the metric, all NaN when no stock reports it
+        """
+        index = self._metric_index.get(name.lower())
+        if index is None:
+            return np.full(self.values.shape[:2], np.nan)
+        return self.values[:, :, index]
+
+    def stock(self, stock_id):
+        """
+        :param stock_id: stock_id from stock_base
+        :return: StockFundamentals of one stock
+        """
+        return StockFundamentals(stock_id, self.years, self.metrics, self.values[self._stock_index[stock_id]])
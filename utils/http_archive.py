@@ -0,0 +1,197 @@
+import asyncio
+import gzip
+import json
+import logging
+import sqlite3
+import threading
+from datetime import timedelta
+from http.client import responses as reasons
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+# Bodies are archived decoded, so headers describing the wire encoding would no longer be true
+_WIRE_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+# Dropped while recording, a bodiless 304 could not be replayed into a parse
+_CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+# Archive used by every HTTP call of the process, set by install()
+_active = None
+
+
+class HttpArchive:
+    """
+    SQLite file of responses keyed by method and url, holding status, headers and the gzipped body.
+    In record mode every response passing through the HTTP layer is stored, in replay mode responses are
+    served from the file and a request that was never recorded fails like a connection error.
+    Requests are recorded without their conditional headers and 304s are never stored, so every archived url has a body.
+    :param path: archive file, created when recording
+    :param mode: record or replay
+    """
+
+    def __init__(self, path, mode=REPLAY):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown archive mode {mode}")
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS response (
+                method text NOT NULL,
+                url text NOT NULL,
+                status integer NOT NULL,
+                headers text NOT NULL,
+                body blob NOT NULL,
+                recordedon timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (method, url)
+            )""")
+
+    @property
+    def replaying(self):
+        return self.mode == REPLAY
+
+    def record(self, method, url, status, headers, body):
+        if status == 304:
+            return
+        headers = {key: value for key, value in headers.items() if key.lower() not in _WIRE_HEADERS}
+        with self._lock, self._conn:
+            self._conn.execute("""
+            INSERT INTO response (method, url, status, headers, body)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (method, url) DO UPDATE
+            SET status = excluded.status,
+                headers = excluded.headers,
+                body = excluded.body,
+                recordedon = CURRENT_TIMESTAMP
+            """, (method, url, status, json.dumps(headers), gzip.compress(body or b'')))
+
+    def lookup(self, method, url):
+        """
+        :return: (status, headers dict, body bytes), None when the request was not recorded
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT status, headers, body FROM response WHERE method = ? AND url = ?",
+                                     (method, url)).fetchone()
+        if row is None:
+            self.logger.warning(f"{method} {url} is not in the archive {self.path}")
+            return None
+        status, headers, body = row
+        return status, json.loads(headers), gzip.decompress(body)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM response").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def install(archive):
+    """
+    Routes the HTTP calls of this process through the archive, None goes back to the network
+    """
+    global _active
+    _active = archive
+
+
+def active():
+    return _active
+
+
+class ArchiveAdapter(HTTPAdapter):
+    """
+    requests transport adapter recording to or replaying from an HttpArchive, takes the HTTPAdapter arguments
+    """
+
+    def __init__(self, archive, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        if self.archive.replaying:
+            entry = self.archive.lookup(request.method, request.url)
+            if entry is None:
+                raise requests.ConnectionError(f"{request.url} is not in the archive", request=request)
+            return self._replayed(request, *entry)
+        for header in _CONDITIONAL_HEADERS:
+            request.headers.pop(header, None)
+        response = super().send(request, **kwargs)
+        self.archive.record(request.method, request.url, response.status_code, response.headers, response.content)
+        return response
+
+    def _replayed(self, request, status, headers, body):
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reasons.get(status, '')
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = timedelta(0)
+        return response
+
+
+def adapter(**kwargs):
+    """
+    :return: adapter to mount on a requests session, archiving when an archive is installed
+    """
+    return ArchiveAdapter(_active, **kwargs) if _active is not None else HTTPAdapter(**kwargs)
+
+
+def get(url, **kwargs):
+    """
+    Drop in for requests.get that goes through the installed archive
+    """
+    if _active is None:
+        return requests.get(url, **kwargs)
+    with requests.Session() as session:
+        session.mount('https://', adapter())
+        session.mount('http://', adapter())
+        return session.get(url, **kwargs)
+
+
+class ArchiveTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport recording to or replaying from an HttpArchive
+    :param archive: HttpArchive
+    :param transport: transport doing the real requests while recording
+    """
+
+    def __init__(self, archive, transport=None):
+        self.archive = archive
+        self.transport = transport if transport is not None else httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        url = str(request.url)
+        if self.archive.replaying:
+            entry = await asyncio.to_thread(self.archive.lookup, request.method, url)
+            if entry is None:
+                raise httpx.ConnectError(f"{url} is not in the archive", request=request)
+            status, headers, body = entry
+            return httpx.Response(status, headers=headers, content=body, request=request)
+        for header in _CONDITIONAL_HEADERS:
+            request.headers.pop(header, None)
+        response = await self.transport.handle_async_request(request)
+        try:
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        headers = {key: value for key, value in response.headers.items() if key.lower() not in _WIRE_HEADERS}
+        await asyncio.to_thread(self.archive.record, request.method, url, response.status_code, headers, body)
+        return httpx.Response(response.status_code, headers=headers, content=body, request=request,
+                              extensions=response.extensions)
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,104 @@
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    """
+    Durable per stock work queue for one task type, backed by the crawl_job table and shared by any number of
+    worker processes or hosts. Jobs are leased in batches with FOR UPDATE SKIP LOCKED so no two workers get the
+    same stock, a lease that is not kept alive by heartbeat() expires and the job is handed to another worker.
+    Failed jobs come back after an exponential backoff until they run out of attempts,
+    a stock that still needs the task gets a fresh set of attempts once failed_cooldown has passed.
+    :param db_utils: DBUtils instance
+    :param task: task type, e.g. fundamentals or sector
+    :param max_attempts: attempts after which a job is left failed
+    :param base_delay: seconds before the first retry, doubled on every further failure
+    :param worker_id: name the jobs are leased under, host:pid by default, must be unique across the cluster
+    :param lease_seconds: seconds a claimed job stays reserved without a heartbeat
+    :param failed_cooldown: Postgres interval before a job out of attempts is queued again, '0 second' for right away
+    """
+
+    def __init__(self, db_utils, task, max_attempts=5, base_delay=600, worker_id=None, lease_seconds=600,
+                 failed_cooldown='7 day'):
+        self.logger = logging.getLogger(__name__)
+        self.db_utils = db_utils
+        self.task = task
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.failed_cooldown = failed_cooldown
+
+    def prepare(self, stock_ids=None, priorities=None):
+        """
+        Creates the table, hands back jobs an earlier run of this worker left running and queues the stocks
+        :param stock_ids: stocks that currently need the task, None to only work off what is queued already
+        :param priorities: optional dict of stock_id -> number, lower numbers are claimed first
+        :return: None
+        """
+        self.db_utils.migrate_crawl_job()
+        self.db_utils.reset_running_jobs(self.task, self.worker_id)
+        if stock_ids is not None:
+            self.db_utils.enqueue_jobs(self.task, stock_ids, priorities, self.failed_cooldown)
+
+    def claim(self, limit=None):
+        """
+        Leases the next due jobs, including jobs of workers whose lease expired
+        :param limit: most jobs to lease, all due jobs when None
+        :return: list of (stock_id, symbol, name), in priority order
+        """
+        rows = self.db_utils.claim_jobs(self.task, self.worker_id, limit, self.lease_seconds)
+        self.logger.info(f"{self.worker_id} leased {len(rows)} {self.task} jobs")
+        return rows
+
+    def extend(self):
+        return self.db_utils.extend_leases(self.task, self.worker_id, self.lease_seconds)
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        """
+        Extends this worker's leases in the background while the block runs,
+        a third of the lease by default so one missed beat does not lose the jobs
+        """
+        stop = threading.Event()
+        interval = interval or self.lease_seconds / 3
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.extend()
+                except Exception:
+                    self.logger.warning("Could not extend leases", exc_info=True)
+
+        thread = threading.Thread(target=beat, name=f'{self.task}-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self):
+        """
+        Hands back jobs leased but not finished, e.g. when the time budget ran out, without counting the attempt
+        """
+        self.db_utils.reset_running_jobs(self.task, self.worker_id)
+
+    def done(self, stock_ids):
+        if stock_ids:
+            self.db_utils.complete_jobs(self.task, self.worker_id, stock_ids)
+
+    def failed(self, rows):
+        """
+        :param rows: list of (stock_id, error message)
+        """
+        if rows:
+            self.db_utils.fail_jobs(self.task, self.worker_id, [(stock_id, str(error)) for stock_id, error in rows],
+                                    self.max_attempts, self.base_delay)
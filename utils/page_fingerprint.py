@@ -0,0 +1,51 @@
+import hashlib
+from collections import namedtuple
+
+from utils.soup_codec import trim_page, trim_tree
+
+# What we know about the stored copy of a stock's page, any field may be None
+PageFingerprint = namedtuple('PageFingerprint', ['etag', 'last_modified', 'content_hash'])
+
+
+def content_hash(content):
+    """
+    Hash of only the financial sections, so ads, timestamps and csrf tokens elsewhere on the page do not count as changes
+    :param content: raw page as bytes or str
+    :return: hex sha256
+    """
+    return hashlib.sha256(trim_page(content)).hexdigest()
+
+
+def tree_hash(tree):
+    """
+    content_hash of a page already parsed with lxml.html, so the parse can be shared with the extraction
+    :param tree: root element of the page
+    :return: hex sha256
+    """
+    return hashlib.sha256(trim_tree(tree)).hexdigest()
+
+
+def conditional_headers(fingerprint):
+    """
+    Validators to send with a re-fetch so an unchanged page can come back as 304
+    :param fingerprint: PageFingerprint of the stored page or None
+    :return: dict of headers
+    """
+    headers = {}
+    if fingerprint is None:
+        return headers
+    if fingerprint.etag:
+        headers['If-None-Match'] = fingerprint.etag
+    if fingerprint.last_modified:
+        headers['If-Modified-Since'] = fingerprint.last_modified
+    return headers
+
+
+def from_response(response, page_hash):
+    """
+    Builds the fingerprint to store for a freshly fetched page, works for requests and httpx responses
+    :param response: response of the page
+    :param page_hash: content_hash of the response body
+    :return: PageFingerprint
+    """
+    return PageFingerprint(response.headers.get('ETag'), response.headers.get('Last-Modified'), page_hash)
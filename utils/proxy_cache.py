@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import time
+
+
+class ProxyCache:
+    """
+    Persistent state of the proxy sources and of proxies already validated, kept in a json file.
+    Every source remembers its last scrape and how many of its proxies turned out valid, so
+    fresh sources are served from cache and sources that keep yielding nothing are retried less often.
+    :param path: json file holding the cache
+    :param max_backoff: cap on the exponent applied to a dead source's ttl
+    """
+
+    def __init__(self, path='proxy_cache.json', max_backoff=5):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.max_backoff = max_backoff
+        self.sources = {}
+        self.valid = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                self.sources = data.get('sources', {})
+                self.valid = data.get('valid', {})
+            except (ValueError, OSError) as e:
+                self.logger.warning(f"Ignoring unreadable proxy cache {path}: {e}")
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'sources': self.sources, 'valid': self.valid}, f)
+        os.replace(tmp_path, self.path)
+
+    def _source(self, key):
+        return self.sources.setdefault(key, {'fetched_at': 0, 'proxies': [], 'scraped': 0, 'valid': 0,
+                                             'yield': None, 'dead_runs': 0, 'pending': False})
+
+    def is_due(self, key, ttl):
+        """
+        :param key: Scraper.key
+        :param ttl: the source's own ttl in seconds
+        :return: True when the source should be scraped again, dead sources wait exponentially longer
+        """
+        source = self._source(key)
+        backoff = 2 ** min(source['dead_runs'], self.max_backoff)
+        return time.time() - source['fetched_at'] >= ttl * backoff
+
+    def cached_proxies(self, key):
+        return list(self._source(key)['proxies'])
+
+    def priority(self, key):
+        # Unknown sources first so they get measured, then by observed yield
+        source_yield = self._source(key)['yield']
+        return 1.0 if source_yield is None else source_yield
+
+    def store(self, key, proxies):
+        source = self._source(key)
+        source['fetched_at'] = time.time()
+        source['proxies'] = sorted(set(proxies))
+        source['scraped'] = len(source['proxies'])
+        # Yield is only measured on fresh scrapes, cached lists were already counted
+        source['pending'] = True
+
+    def kept_proxies(self, max_age):
+        """
+        Proxies validated recently enough to be trusted without another check
+        :param max_age: seconds since the last successful check
+        :return: dict of proxy -> latency
+        """
+        now = time.time()
+        return {proxy: info['latency'] for proxy, info in self.valid.items() if now - info['checked_at'] < max_age}
+
+    def record_check(self, checked, valid, smoothing=0.5):
+        """
+        Stores a checker run and credits every source with the valid proxies it supplied
+        :param checked: proxies that were checked in this run
+        :param valid: dict of proxy -> latency for those that passed
+        :param smoothing: weight of this run in each source's yield average
+        """
+        now = time.time()
+        for proxy in checked:
+            if proxy not in valid:
+                self.valid.pop(proxy, None)
+        for proxy, latency in valid.items():
+            self.valid[proxy] = {'latency': latency, 'checked_at': now}
+
+        live = set(self.valid)
+        checked = set(checked)
+        for key, source in self.sources.items():
+            if not source.get('pending'):
+                continue
+            source['pending'] = False
+            if not source['proxies']:
+                source['dead_runs'] += 1
+                continue
+            source['valid'] = len(live.intersection(source['proxies']))
+            # Proxies kept from earlier checks or cut off by max_valid were not tested in this run
+            tested = checked.intersection(source['proxies'])
+            if not tested:
+                continue
+            run_yield = len(tested.intersection(valid)) / len(tested)
+            source['yield'] = run_yield if source['yield'] is None \
+                else smoothing * run_yield + (1 - smoothing) * source['yield']
+            source['dead_runs'] = source['dead_runs'] + 1 if source['valid'] == 0 else 0
+
+    def report(self):
+        """
+        :return: list of (source, scraped, valid, yield, dead_runs), best yielding first
+        """
+        rows = [(key, s['scraped'], s['valid'], s['yield'], s['dead_runs']) for key, s in self.sources.items()]
+        return sorted(rows, key=lambda row: row[3] or 0, reverse=True)
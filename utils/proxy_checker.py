@@ -1,12 +1,15 @@
 import argparse
+import asyncio
 import random
 import re
-import socket
-import threading
-import urllib.request
 from time import time
 
-import socks
+import httpx
+
+try:
+    from httpx_socks import AsyncProxyTransport
+except ImportError:
+    AsyncProxyTransport = None
 
 user_agents = []
 with open("user_agents.txt", "r") as f:
@@ -20,42 +23,42 @@ class Proxy:
             raise NotImplementedError("Only HTTP, HTTPS, SOCKS4, and SOCKS5 are supported")
         self.method = method.lower()
         self.proxy = proxy
+        self.latency = None
 
     def is_valid(self):
         return re.match(r"\d{1,3}(?:\.\d{1,3}){3}(?::\d{1,5})?$", self.proxy)
 
-    def check(self, site, timeout, user_agent, verbose):
-        if self.method in ["socks4", "socks5"]:
-            socks.set_default_proxy(socks.SOCKS4 if self.method == "socks4" else socks.SOCKS5,
-                                    self.proxy.split(':')[0], int(self.proxy.split(':')[1]))
-            socket.socket = socks.socksocket
-            try:
-                start_time = time()
-                urllib.request.urlopen(site, timeout=timeout)
-                end_time = time()
-                time_taken = end_time - start_time
-                verbose_print(verbose, f"Proxy {self.proxy} is valid, time taken: {time_taken}")
-                return True, time_taken, None
-            except Exception as e:
-                verbose_print(verbose, f"Proxy {self.proxy} is not valid, error: {str(e)}")
-                return False, 0, e
-        else:
-            url = self.method + "://" + self.proxy
-            proxy_support = urllib.request.ProxyHandler({self.method: url})
-            opener = urllib.request.build_opener(proxy_support)
-            urllib.request.install_opener(opener)
-            req = urllib.request.Request(self.method + "://" + site)
-            req.add_header("User-Agent", user_agent)
-            try:
+    def client(self, timeout):
+        """
+        Builds a client bound to this proxy only, nothing process wide is touched
+        :param timeout: connect/read timeout in seconds
+        :return: httpx.AsyncClient
+        """
+        if self.method == "socks4" or (self.method == "socks5" and AsyncProxyTransport is not None):
+            if AsyncProxyTransport is None:
+                raise NotImplementedError("SOCKS4 checks need the httpx-socks package")
+            transport = AsyncProxyTransport.from_url(f"{self.method}://{self.proxy}")
+            return httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True)
+        # http and https proxies both take plain http CONNECT, socks5 uses httpx's own socksio support
+        scheme = "socks5" if self.method == "socks5" else "http"
+        return httpx.AsyncClient(proxy=f"{scheme}://{self.proxy}", timeout=timeout, follow_redirects=True)
+
+    async def check(self, site, timeout, user_agent, verbose):
+        if "://" not in site:
+            site = ("http" if self.method == "http" else "https") + "://" + site
+        try:
+            async with self.client(timeout) as client:
                 start_time = time()
-                urllib.request.urlopen(req, timeout=timeout)
+                response = await client.get(site, headers={"User-Agent": user_agent})
+                response.raise_for_status()
                 end_time = time()
-                time_taken = end_time - start_time
-                verbose_print(verbose, f"Proxy {self.proxy} is valid, time taken: {time_taken}")
-                return True, time_taken, None
-            except Exception as e:
-                verbose_print(verbose, f"Proxy {self.proxy} is not valid, error: {str(e)}")
-                return False, 0, e
+            time_taken = end_time - start_time
+            self.latency = time_taken
+            verbose_print(verbose, f"Proxy {self.proxy} is valid, time taken: {time_taken}")
+            return True, time_taken, None
+        except Exception as e:
+            verbose_print(verbose, f"Proxy {self.proxy} is not valid, error: {str(e)}")
+            return False, 0, e
 
     def __str__(self):
         return self.proxy
@@ -74,41 +77,59 @@ def verbose_print(verbose, message):
         else:
             echo(message, color=GREEN)
 
-def _check(file, timeout, method, site, verbose, random_user_agent):
+async def _check(file, timeout, method, site, verbose, random_user_agent, concurrency, max_valid):
     proxies = []
     with open(file, "r") as f:
         for line in f:
-            proxies.append(Proxy(method, line.replace("\n", "")))
+            # Earlier runs may have written the latency after the proxy
+            if line.split():
+                proxies.append(Proxy(method, line.split()[0]))
 
     print(f"Checking {len(proxies)} proxies")
-    proxies = filter(lambda x: x.is_valid(), proxies)
+    proxies = [proxy for proxy in proxies if proxy.is_valid()]
     valid_proxies = []
+    checked_proxies = []
     user_agent = random.choice(user_agents)
+    semaphore = asyncio.Semaphore(concurrency)
 
-    def check_proxy(proxy, user_agent):
+    async def check_proxy(proxy):
         new_user_agent = user_agent
         if random_user_agent:
             new_user_agent = random.choice(user_agents)
-        valid, time_taken, error = proxy.check(site, timeout, new_user_agent, verbose)
-        valid_proxies.extend([proxy] if valid else [])
-
-    threads = []
-    for proxy in proxies:
-        t = threading.Thread(target=check_proxy, args=(proxy, user_agent))
-        threads.append(t)
-
-    for t in threads:
-        t.start()
-
-    for t in threads:
-        t.join()
-
+        async with semaphore:
+            valid, time_taken, error = await proxy.check(site, timeout, new_user_agent, verbose)
+        return proxy, valid
+
+    tasks = [asyncio.create_task(check_proxy(proxy)) for proxy in proxies]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            proxy, valid = await finished
+            checked_proxies.append(proxy)
+            if valid:
+                valid_proxies.append(proxy)
+                if max_valid and len(valid_proxies) >= max_valid:
+                    verbose_print(verbose, f"Found {max_valid} valid proxies, stopping early")
+                    break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Fastest first, the latency lets ProxyPool weight proxies before it has its own samples
+    valid_proxies.sort(key=lambda proxy: proxy.latency)
     with open(file, "w") as f:
         for proxy in valid_proxies:
-            f.write(str(proxy) + "\n")
+            f.write(f"{proxy} {proxy.latency:.3f}\n")
 
     print(f"Found {len(valid_proxies)} valid proxies")
+    return [str(proxy) for proxy in checked_proxies], {str(proxy): proxy.latency for proxy in valid_proxies}
 
 
-def checker(timeout=20, proxy='http', file='http.txt', site='https://screener.in/', verbose=False, random_agent=False):
-    _check(file=file, timeout=timeout, method=proxy, site=site, verbose=verbose, random_user_agent=random_agent)
\ No newline at end of file
+def checker(timeout=20, proxy='http', file='http.txt', site='https://screener.in/', verbose=False, random_agent=False,
+            concurrency=200, max_valid=None):
+    """
+    Checks every proxy in file and rewrites it with the valid ones
+    :return: proxies whose check completed, dict of valid proxy -> latency
+    """
+    return asyncio.run(_check(file=file, timeout=timeout, method=proxy, site=site, verbose=verbose,
+                       random_user_agent=random_agent, concurrency=concurrency, max_valid=max_valid))
@@ -0,0 +1,131 @@
+import logging
+import random
+import threading
+
+
+class ProxyStats:
+    """
+    Running health of one proxy
+    :param proxy: ip:port
+    :param latency: initial latency estimate in seconds, e.g. the checker's time_taken
+    """
+
+    def __init__(self, proxy, latency=None):
+        self.proxy = proxy
+        self.latency = latency
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+
+    @property
+    def success_rate(self):
+        # Laplace smoothing so new proxies start at 0.5 instead of 0 or 1
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def score(self, default_latency):
+        return self.success_rate / max(self.latency or default_latency, 0.05)
+
+
+class ProxyPool:
+    """
+    Thread safe proxy pool that routes requests weighted by success rate and latency
+    and evicts proxies after consecutive failures. An empty pool means direct connections.
+    :param proxies: list of ip:port or (ip:port, latency) entries
+    :param max_failures: consecutive failures after which a proxy is dropped
+    :param smoothing: weight of the newest sample in the latency moving average
+    """
+
+    def __init__(self, proxies=(), max_failures=3, smoothing=0.3):
+        self.logger = logging.getLogger(__name__)
+        self.max_failures = max_failures
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._stats = {}
+        for entry in proxies:
+            proxy, latency = entry if isinstance(entry, tuple) else (entry, None)
+            self._stats.setdefault(proxy, ProxyStats(proxy, latency))
+
+    @classmethod
+    def from_file(cls, proxies_file, **kwargs):
+        """
+        Reads a proxies file, one proxy per line optionally followed by its latency in seconds
+        :param proxies_file: path of the file written by proxy_checker
+        :return: ProxyPool
+        """
+        entries = []
+        try:
+            with open(proxies_file, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if not parts:
+                        continue
+                    latency = float(parts[1]) if len(parts) > 1 else None
+                    entries.append((parts[0], latency))
+        except FileNotFoundError:
+            logging.getLogger(__name__).warning(f"Proxy file {proxies_file} not found, using direct connections")
+        return cls(entries, **kwargs)
+
+    def __len__(self):
+        return len(self._stats)
+
+    def choose(self):
+        """
+        Picks a proxy at random, weighted by health
+        :return: ip:port or None when the pool is empty
+        """
+        with self._lock:
+            if not self._stats:
+                return None
+            stats = list(self._stats.values())
+            known = [s.latency for s in stats if s.latency]
+            default_latency = sum(known) / len(known) if known else 1.0
+            return random.choices(stats, weights=[s.score(default_latency) for s in stats])[0].proxy
+
+    def report_success(self, proxy, latency=None):
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is None:
+                return
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            if latency is not None:
+                stats.latency = latency if stats.latency is None \
+                    else self.smoothing * latency + (1 - self.smoothing) * stats.latency
+
+    def report_failure(self, proxy):
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is None:
+                return
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= self.max_failures:
+                del self._stats[proxy]
+                self.logger.info(f"Evicted proxy {proxy} after {stats.consecutive_failures} failures, "
+                                 f"{len(self._stats)} left")
+
+    def snapshot(self):
+        """
+        :return: list of (proxy, success_rate, latency) for every live proxy, healthiest first
+        """
+        with self._lock:
+            stats = sorted(self._stats.values(), key=lambda s: s.score(1.0), reverse=True)
+            return [(s.proxy, s.success_rate, s.latency) for s in stats]
+
+
+def requests_proxies(proxy):
+    """
+    :param proxy: ip:port or None
+    :return: proxies dict for requests, https traffic is tunnelled through the http proxy with CONNECT
+    """
+    if proxy is None:
+        return {}
+    return {'http': f'http://{proxy}', 'https': f'http://{proxy}'}
+
+
+def httpx_proxy(proxy):
+    """
+    :param proxy: ip:port or None
+    :return: proxy url for an httpx client
+    """
+    return None if proxy is None else f'http://{proxy}'
@@ -10,11 +10,17 @@ from bs4 import BeautifulSoup
 
 
 class Scraper:
+    # Seconds a scraped list stays usable from the proxy cache, sources override it with their refresh rate
+    ttl = 15 * 60
 
     def __init__(self, method, _url):
         self.method = method
         self._url = _url
 
+    @property
+    def key(self):
+        return f"{type(self).__name__}:{self.method}:{self.get_url()}"
+
     def get_url(self, **kwargs):
         return self._url.format(**kwargs, method=self.method)
 
@@ -33,6 +39,7 @@ class Scraper:
 
 # From spys.me
 class SpysMeScraper(Scraper):
+    ttl = 60 * 60
 
     def __init__(self, method):
         super().__init__(method, "https://spys.me/{mode}.txt")
@@ -46,6 +53,7 @@ class SpysMeScraper(Scraper):
 
 # From proxyscrape.com
 class ProxyScrapeScraper(Scraper):
+    ttl = 10 * 60
 
     def __init__(self, method, timeout=1000, country="All"):
         self.timout = timeout
@@ -79,6 +87,7 @@ class GeoNodeScraper(Scraper):
 
 # From proxy-list.download
 class ProxyListDownloadScraper(Scraper):
+    ttl = 30 * 60
 
     def __init__(self, method, anon):
         self.anon = anon
@@ -90,6 +99,7 @@ class ProxyListDownloadScraper(Scraper):
 
 # For websites using table in html
 class GeneralTableScraper(Scraper):
+    ttl = 10 * 60
 
     async def handle(self, response):
         soup = BeautifulSoup(response.text, "html.parser")
@@ -131,7 +141,7 @@ def verbose_print(verbose, message):
         print(message)
 
 
-async def _scrape(method, output, verbose):
+async def _scrape(method, output, verbose, cache=None):
     now = time.time()
     methods = [method]
     if method == "socks":
@@ -148,14 +158,26 @@ async def _scrape(method, output, verbose):
     async def scrape_scraper(scraper):
         try:
             verbose_print(verbose, f"Looking {scraper.get_url()}...")
-            proxies.extend(await scraper.scrape(client))
+            found = await scraper.scrape(client)
         except Exception:
-            pass
-
+            # Left unstamped so the source is tried again next run, its last good list is used meanwhile
+            return cache.cached_proxies(scraper.key) if cache is not None else []
+        if cache is not None:
+            cache.store(scraper.key, found)
+        return found
+
+    if cache is not None:
+        # Best yielding sources first so their proxies win the de-duplication downstream
+        proxy_scrapers.sort(key=lambda s: cache.priority(s.key), reverse=True)
     for scraper in proxy_scrapers:
-        tasks.append(asyncio.ensure_future(scrape_scraper(scraper)))
-
-    await asyncio.gather(*tasks)
+        if cache is not None and not cache.is_due(scraper.key, scraper.ttl):
+            verbose_print(verbose, f"Using cached {scraper.get_url()}")
+            tasks.append(asyncio.ensure_future(asyncio.sleep(0, result=cache.cached_proxies(scraper.key))))
+        else:
+            tasks.append(asyncio.ensure_future(scrape_scraper(scraper)))
+
+    for found in await asyncio.gather(*tasks):
+        proxies.extend(found)
     await client.aclose()
 
     verbose_print(verbose, f"Writing {len(proxies)} proxies to file...")
@@ -165,14 +187,14 @@ async def _scrape(method, output, verbose):
     verbose_print(verbose, f"Took {time.time() - now} seconds")
 
 
-def scraper(proxy='http', output='proxies.txt', verbose=False):
+def scraper(proxy='http', output='proxies.txt', verbose=False, cache=None):
     if sys.version_info >= (3, 7) and platform.system() == 'Windows':
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(_scrape(proxy, output, verbose))
+        loop.run_until_complete(_scrape(proxy, output, verbose, cache))
         loop.close()
     elif sys.version_info >= (3, 7):
-        asyncio.run(_scrape(proxy, output, verbose))
+        asyncio.run(_scrape(proxy, output, verbose, cache))
     else:
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(_scrape(proxy, output, verbose))
-        loop.close()
\ No newline at end of file
+        loop.run_until_complete(_scrape(proxy, output, verbose, cache))
+        loop.close()
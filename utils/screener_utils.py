@@ -1,89 +1,278 @@
 import json
-import random
 import re
 
 import logging
-import sys
+import threading
+from datetime import datetime, timedelta
 
-from requests import Session, session
-from requests.adapters import HTTPAdapter, Retry
+import lxml.html
+from lxml import etree
+from requests import session
+from requests.adapters import Retry
 from bs4 import BeautifulSoup
 
-from fp.fp import FreeProxy
+from utils import http_archive
+from utils.proxy_pool import ProxyPool, requests_proxies
 
 SEARCH_API = "https://www.screener.in/api/company/search/?q="
 SCREENER_URL = "https://www.screener.in"
 
-file_path = r'C:\Users\suwee\CodeBase\_ Personal Projects\Stonks\proxies.txt'
+file_path = 'proxies.txt'
 
-proxies = []
-with open(file_path, 'r') as file:
-    for line in file:
-        line = line.strip()  # Remove extra whitespace characters
-        if line:
-            proxies.append(line)
+# Shared by every Screener that is not handed a pool, loaded on first use
+_default_pool = None
+
+
+def _has_class(*classes):
+    return "".join(f"[contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')]" for cls in classes)
+
+
+# Compiled once, these mirror the CSS selectors stock_information used to run through soupsieve
+_TOP = "//*[@id='top']"
+_PROFILE_LINKS = (f"{_TOP}/div{_has_class('company-info')}/div{_has_class('company-profile')}"
+                  f"/div{_has_class('company-links', 'hide-from-tablet-landscape', 'margin-top-20')}")
+STOCK_XPATHS = {
+    "name": etree.XPath(f"{_TOP}/div{_has_class('flex', 'flex-space-between', 'flex-gap-8')}/div/h1"),
+    "link": etree.XPath(f"{_TOP}/div{_has_class('company-links', 'show-from-tablet-landscape')}/*[1][self::a]"),
+    "about": etree.XPath(f"{_TOP}//*{_has_class('company-info')}//*{_has_class('company-profile')}//p"),
+    "bse_link": etree.XPath(f"{_PROFILE_LINKS}/*[2][self::a]"),
+    "nse_link": etree.XPath(f"{_PROFILE_LINKS}/*[3][self::a]"),
+}
+_PEERS = etree.XPath("//*[@id='peers']")
+_SUB = etree.XPath(f".//*{_has_class('sub')}")
+_MARKET_LINKS = etree.XPath(".//a[starts-with(@href, '/market/')]/@href")
+_PEER_LINKS = etree.XPath(".//table//a[starts-with(@href, '/company/')]/@href")
+_SECTOR_SPLIT = re.compile(r"\s\s")
+_PEERS_START = re.compile(rb'<section[^>]*\bid="peers"')
+
+TOP_FIELDS = ("name", "about", "link", "bse_link", "nse_link")
+PEER_FIELDS = ("sector", "industry")
+
+
+def default_proxy_pool():
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ProxyPool.from_file(file_path)
+    return _default_pool
+
+
+class ScreenerError(Exception):
+    """
+    Raised when a stock cannot be resolved or its page cannot be fetched, callers decide whether to carry on
+    """
+
+
+class ScreenerNotFound(ScreenerError):
+    """
+    Raised when the search API has no company for the ticker or the name
+    """
+
+
+class ScreenerUrlCache:
+    """
+    Persisted symbol -> screener company url resolution, backed by stock_base.screener_url.
+    Misses are cached too (url NULL with a resolution time) and retried once negative_ttl has passed.
+    :param db_utils: DBUtils instance
+    :param index_id: index whose stocks are loaded
+    :param negative_ttl: how long a failed resolution is trusted
+    """
+
+    def __init__(self, db_utils, index_id, negative_ttl=timedelta(days=7)):
+        self.logger = logging.getLogger(__name__)
+        self.db_utils = db_utils
+        self.index_id = index_id
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._entries = db_utils.get_screener_urls(index_id) or {}
+
+    def get(self, symbol):
+        """
+        :param symbol: symbol as in stock_base
+        :return: (hit, url path) where a hit with path None is a cached miss
+        """
+        with self._lock:
+            entry = self._entries.get(symbol)
+        if entry is None:
+            return False, None
+        stock_id, url, resolved_on = entry
+        if url:
+            return True, url
+        if resolved_on is not None and datetime.now() - resolved_on < self.negative_ttl:
+            return True, None
+        return False, None
+
+    def put(self, symbol, url):
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is None:
+                return
+            self._entries[symbol] = (entry[0], url, datetime.now())
+            self._pending[entry[0]] = url
+
+    def flush(self):
+        with self._lock:
+            rows = [(url, stock_id) for stock_id, url in self._pending.items()]
+            self._pending.clear()
+        if rows:
+            self.db_utils.update_screener_urls(rows)
+
+    def invalidate(self, symbols=None):
+        """
+        Forgets cached resolutions so they are searched again
+        :param symbols: symbols to forget, everything in the index when None
+        """
+        self.db_utils.invalidate_screener_urls(self.index_id, symbols)
+        with self._lock:
+            for symbol in list(self._entries) if symbols is None else symbols:
+                if symbol in self._entries:
+                    self._entries[symbol] = (self._entries[symbol][0], None, None)
 
 
 class Screener:
     """
     This class acts as a Base for Screener related process
     :param ticker: symbol of stock
+    :param name: name of the stock, searched when the ticker finds nothing
+    :param proxy_pool: ProxyPool to route through, defaults to the pool read from proxies.txt
+    :param url_cache: ScreenerUrlCache consulted before the search API
+    :param cache_key: symbol the url is cached under, defaults to ticker
+    :param limiter: AdaptiveConcurrency shared by all Screener instances of a run
     """
 
-    def __init__(self, ticker, name):
+    def __init__(self, ticker, name, proxy_pool=None, url_cache=None, cache_key=None, limiter=None):
         self.logger = logging.getLogger(__name__)
         self.logger.info(f"Invoked Screener Module for {ticker}")
         self.name = name
         self.ticker = ticker
-        random_number = random.randint(0, len(proxies)-1)
+        self.url_cache = url_cache
+        self.cache_key = cache_key or ticker
+        self.proxy_pool = proxy_pool if proxy_pool is not None else default_proxy_pool()
+        self.limiter = limiter
         self.session = session()
-        self.proxy = proxies[random_number]
-        session().proxies['http'] = f'http://{self.proxy}'
-        session().proxies['https'] = f'https://{self.proxy}'
+        self.proxy = self.proxy_pool.choose()
+        self.session.proxies.update(requests_proxies(self.proxy))
+        # Only transient statuses are retried, waiting as long as Retry-After asks. 4xx other than 429 will not
+        # change on a retry and a 403 is reported to the pool and the limiter instead
         retries = Retry(total=3,
-                        backoff_factor=0.1,
-                        status_forcelist=[500, 502, 503, 504, 400, 401, 402, 403])
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+                        backoff_factor=1,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        respect_retry_after_header=True)
+        self.session.mount('https://', http_archive.adapter(max_retries=retries))
         self.session.timeout = 30  # timeout for 30 seconds
         self.url = SCREENER_URL + self._get_url()
-        self.soup = self.get_soup()
+        # The page is only downloaded and parsed once something asks for it
+        self._page = None
+        self._soup = None
+        self._tree = None
+
+    def _get(self, url):
+        """
+        GET through the session's proxy, reporting the outcome back to the pool
+        :param url: url to fetch
+        :return: response
+        """
+        if self.limiter is not None:
+            self.limiter.acquire(lambda: self.proxy)
+        try:
+            response = self.session.get(url)
+        except Exception as e:
+            if self.limiter is not None:
+                self.limiter.release(self.proxy, error=e)
+            self.proxy_pool.report_failure(self.proxy)
+            raise
+        if self.limiter is not None:
+            self.limiter.release(self.proxy, response.status_code, retry_after=response.headers.get('Retry-After'))
+        if response.status_code in (403, 407, 429) or response.status_code >= 500:
+            self.proxy_pool.report_failure(self.proxy)
+        else:
+            self.proxy_pool.report_success(self.proxy, response.elapsed.total_seconds())
+        return response
 
     def _get_url(self):
         """
         Encapsulated function to get url for a particular stock from the screener site
         :return:
         """
+        if self.url_cache is not None:
+            hit, url = self.url_cache.get(self.cache_key)
+            if hit and url is None:
+                raise ScreenerNotFound(f"{self.ticker} is cached as not found on screener")
+            if hit:
+                return url
         response = None
         try:
-            response = self.session.get(SEARCH_API + self.ticker)
+            response = self._get(SEARCH_API + self.ticker)
             if response.status_code == 200:
                 print(f"Proxy {self.proxy} is working.")
             search_list = response.json()
             if len(search_list) == 0:
-                response = self.session.get(SEARCH_API + self.name)
+                response = self._get(SEARCH_API + self.name)
                 search_list = response.json()
-            return search_list[0]['url']
+            if len(search_list) == 0:
+                if self.url_cache is not None:
+                    self.url_cache.put(self.cache_key, None)
+                raise ScreenerNotFound(f"No screener company found for {self.ticker} / {self.name}")
+            url = search_list[0]['url']
+            if self.url_cache is not None:
+                self.url_cache.put(self.cache_key, url)
+            return url
+        except ScreenerError:
+            raise
         except Exception as e:
             print('getting url', e)
             print(response)
-            sys.exit()
+            raise ScreenerError(f"Could not resolve url for {self.ticker}: {e}") from e
+
+    @property
+    def page(self):
+        if self._page is None:
+            try:
+                self._page = self._get(self.url).content
+            except Exception as e:
+                print("getting page", e)
+                raise ScreenerError(f"Could not fetch page for {self.ticker}: {e}") from e
+        return self._page
+
+    @property
+    def soup(self):
+        if self._soup is None:
+            self._soup = self.get_soup()
+        return self._soup
 
     def get_soup(self):
         try:
-            self.url = self.session.get(self.url).text
-            soup = BeautifulSoup(self.url, "html.parser")
+            soup = BeautifulSoup(self.page, "html.parser")
             return soup
+        except ScreenerError:
+            raise
         except Exception as e:
             print("getting soup", e)
-            sys.exit()
+            raise ScreenerError(f"Could not fetch page for {self.ticker}: {e}") from e
 
-    def stock_information(self):
+    @property
+    def tree(self):
+        """
+        lxml tree of the page up to the end of #peers, everything stock_information reads comes before it
         """
-        Retrieves stock information from the self.soup object and
+        if self._tree is None:
+            page = self.page
+            match = _PEERS_START.search(page)
+            if match is not None:
+                end = page.find(b"</section>", match.end())
+                if end != -1:
+                    page = page[:end + len(b"</section>")]
+            self._tree = lxml.html.fromstring(page)
+        return self._tree
+
+    def stock_information(self, fields=None):
+        """
+        Retrieves stock information from the page and
         returns a dictionary containing the following information:
 
         Parameters:
         - self: The instance of the class.
+        - fields: Keys to extract, all of them when None. Only the requested lookups run.
 
         Returns:
         - stock_info: A dictionary containing the following keys:
@@ -95,45 +284,69 @@ class Screener:
             - sector: The sector the stock belongs to.
             - industry: The industry the stock belongs to.
         """
+        wanted = set(fields) if fields is not None else set(TOP_FIELDS + PEER_FIELDS)
+        tree = self.tree
         stock_info = {}
 
-        name = self.soup.select(
-            "#top > div.flex.flex-space-between.flex-gap-8 > div > h1"
-        )[0].text.strip()
-        link = self.soup.select(
-            "#top > div.company-links.show-from-tablet-landscape > a:nth-child(1)"
-        )[0].attrs["href"]
-        about = self.soup.select("#top .company-info .company-profile p")[0].text
-        bse_link = self.soup.select(
-            "#top > div.company-info > div.company-profile > div.company-links.hide-from-tablet-landscape.margin-top-20 > a:nth-child(2)"
-        )[0].attrs["href"]
-        try:
-            nse_link = self.soup.select(
-                "#top > div.company-info > div.company-profile > div.company-links.hide-from-tablet-landscape.margin-top-20 > a:nth-child(3)"
-            )[0].attrs["href"]
-        except:
-            nse_link = ""
-
-        sector = self.soup.select("#peers")[0]
-        sector_industry = [
-            term
-            for term in re.split(
-                "\s\s", sector.find_all(class_="sub")[0].text.replace("\n", "").strip()
-            )
-            if term != ""
-        ]
-        sector = sector_industry[1]
-        industry = sector_industry[3]
-
-        stock_info["name"] = name
-        stock_info["about"] = about
-        stock_info["link"] = link
-        stock_info["bse_link"] = bse_link
-        stock_info["nse_link"] = nse_link
-        stock_info["sector"] = sector
-        stock_info["industry"] = industry
+        if "name" in wanted:
+            stock_info["name"] = STOCK_XPATHS["name"](tree)[0].text_content().strip()
+        if "about" in wanted:
+            stock_info["about"] = STOCK_XPATHS["about"](tree)[0].text_content()
+        for field in ("link", "bse_link"):
+            if field in wanted:
+                stock_info[field] = STOCK_XPATHS[field](tree)[0].attrib["href"]
+        if "nse_link" in wanted:
+            nse_link = STOCK_XPATHS["nse_link"](tree)
+            stock_info["nse_link"] = nse_link[0].get("href", "") if nse_link else ""
+
+        if wanted.intersection(PEER_FIELDS):
+            sub = _SUB(_PEERS(tree)[0])[0]
+            sector_industry = [
+                term
+                for term in _SECTOR_SPLIT.split(sub.text_content().replace("\n", "").strip())
+                if term != ""
+            ]
+            if "sector" in wanted:
+                stock_info["sector"] = sector_industry[1]
+            if "industry" in wanted:
+                stock_info["industry"] = sector_industry[3]
         return stock_info
 
+    def peer_companies(self, max_pages=5):
+        """
+        Company pages of the stock's peers, they share its sector and industry
+        :param max_pages: industry listing pages to walk when the peer table is not in the page
+        :return: sorted list of screener company url paths
+        """
+        peers = _PEERS(self.tree)[0]
+        links = set(_PEER_LINKS(peers))
+        if links:
+            return sorted(links)
+
+        # The peer table is filled in by javascript, the industry listing linked from the section has the same companies
+        industry_links = _MARKET_LINKS(_SUB(peers)[0])
+        if not industry_links:
+            return []
+        industry_url = SCREENER_URL + industry_links[-1]
+        for page in range(1, max_pages + 1):
+            response = self._get(f"{industry_url}?page={page}")
+            if response.status_code != 200:
+                break
+            found = set(_PEER_LINKS(lxml.html.fromstring(response.content)))
+            if not found - links:
+                break
+            links |= found
+        return sorted(links)
+
+
+def company_symbol(url):
+    """
+    :param url: screener company url path, e.g. /company/TCS/consolidated/
+    :return: symbol part of the path, matches stock_base.symbol for NSE listed companies
+    """
+    parts = [part for part in url.split("/") if part]
+    return parts[1] if len(parts) > 1 and parts[0] == "company" else None
+
 
 # screen = Screener('ICICIBANK')
 # a = screen.stock_information()
@@ -0,0 +1,78 @@
+import gzip
+
+from lxml import etree, html
+
+from utils.extract_yearly_data import YEARLY_SECTIONS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def trim_page(content):
+    """
+    Keeps only the sections extract_yearly_data reads, dropping scripts, nav, quarterly tables etc.
+    :param content: raw page as bytes or str
+    :return: minimal html document as bytes
+    """
+    return trim_tree(html.fromstring(content))
+
+
+def trim_tree(tree):
+    """
+    trim_page for a document already parsed with lxml.html
+    :param tree: root element of the page
+    :return: minimal html document as bytes
+    """
+    kept = []
+    for section_id, _ in YEARLY_SECTIONS.values():
+        for section in tree.xpath('//section[@id=$section_id]', section_id=section_id):
+            kept.append(etree.tostring(section, encoding='utf-8'))
+    return b'<html><body>' + b''.join(kept) + b'</body></html>'
+
+
+def compress_page(content, trim=False, level=None):
+    """
+    Compresses a raw page for raw_soup_base, zstd when available otherwise gzip
+    :param content: raw page as bytes or str
+    :param trim: store only the yearly sections
+    :param level: compression level, library default when None
+    :return: compressed bytes
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if trim:
+        content = trim_page(content)
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level or 3).compress(content)
+    return gzip.compress(content, compresslevel=level or 6)
+
+
+def decompress_page(data):
+    """
+    Reverses compress_page, the format is detected from the magic bytes
+    :param data: bytes/memoryview from the bytea column
+    :return: html as str
+    """
+    data = bytes(data)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this raw soup")
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif data.startswith(GZIP_MAGIC):
+        data = gzip.decompress(data)
+    return data.decode('utf-8', 'replace')
+
+
+def decode_soup(soup, soup_zip):
+    """
+    Returns the page of a raw_soup_base row, rows written before compression only have the text column
+    :param soup: screener_soup text column
+    :param soup_zip: screener_soup_zip bytea column
+    :return: html as str
+    """
+    return decompress_page(soup_zip) if soup_zip is not None else soup
@@ -0,0 +1,39 @@
+CONSOLIDATED = 'consolidated'
+STANDALONE = 'standalone'
+
+# Most listed companies publish consolidated statements, so a stock without a remembered variant starts there
+DEFAULT_VARIANT = CONSOLIDATED
+
+
+def company_url(symbol, variant=DEFAULT_VARIANT):
+    """
+    :param symbol: symbol as in stock_base
+    :param variant: consolidated or standalone
+    :return: screener company page of that statement variant
+    """
+    if variant == STANDALONE:
+        return f'https://www.screener.in/company/{symbol}/'
+    return f'https://www.screener.in/company/{symbol}/consolidated/'
+
+
+def variant_of(url):
+    return CONSOLIDATED if '/consolidated/' in url else STANDALONE
+
+
+def other_variant_url(url):
+    """
+    :return: url of the same company page in the other statement variant
+    """
+    if variant_of(url) == CONSOLIDATED:
+        return url.replace('/consolidated/', '/')
+    return url.rstrip('/') + '/consolidated/'
+
+
+def changed_variant(url, known):
+    """
+    :param url: company page that gave valid data
+    :param known: variant remembered for the stock, None when there is none
+    :return: variant of url when it has to be remembered, None when it is already known
+    """
+    variant = variant_of(url)
+    return variant if variant != known else None
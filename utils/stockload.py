@@ -1,6 +1,9 @@
+import hashlib
+import io
 import json
 import os
 import sys
+import threading
 from time import sleep
 
 import dotenv
@@ -8,92 +11,156 @@ import logging
 
 import psycopg2
 from psycopg2 import Error
+from psycopg2.extras import execute_values
 import pandas as pd
 
+from utils import http_archive
+from utils.db_pool import ConnectionPool
+from utils.page_fingerprint import PageFingerprint
+from utils.soup_codec import compress_page, decode_soup
+
 
 class DBUtils:
-    def __init__(self):
+    def __init__(self, min_pool_size=None, max_pool_size=None):
         self.logger = logging.getLogger(__name__)
         dotenv.load_dotenv()
         self.logger.debug("DB Utils Initiated")
         self.db_params = json.loads(os.getenv("STONKS_DB_CREDS").replace("'", "\""))
+        self.min_pool_size = int(min_pool_size or os.getenv("STONKS_DB_POOL_MIN", 1))
+        self.max_pool_size = int(max_pool_size or os.getenv("STONKS_DB_POOL_MAX", 10))
+        # Store only the sections extract_yearly_data reads instead of the full page
+        self.trim_soup = os.getenv("STONKS_TRIM_SOUP", "false").lower() in ("1", "true", "yes")
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self):
+        # Created lazily so importing modules that build a DBUtils does not open connections
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(self.db_params, self.min_pool_size, self.max_pool_size)
+        return self._pool
+
+    def connection(self):
+        """
+        Context manager handing out a pooled connection, committed on exit and rolled back on error
+        :return: psycopg2 connection
+        """
+        return self.pool.connection()
 
-    def get_connection(self, db_params):
-        try:
-            connection = psycopg2.connect(**db_params)
-            self.logger.debug("Connection Created!")
-            return connection
-        except (Exception, Error) as error:
-            self.logger.critical(f"Error initiating DB connection {error}\n", exc_info=True)
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+            self.logger.debug("Closing Stonks DB connections")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def get_index_info(self, index):
-        db_params = json.loads(os.getenv("STONKS_DB_CREDS").replace("'", "\""))
-        conn = self.get_connection(db_params)
-        cursor = conn.cursor()
         query = f"""select index_id, name, link, linktype, country, modifiedon
                     from index_base ib
                     where name = '{index.upper()}'"""
         try:
-            cursor.execute(query)
-            result = cursor.fetchmany()
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query)
+                result = cursor.fetchmany()
             self.logger.debug("Fetch from Index Base Successful")
             return result
         except (Exception, Error):
             self.logger.critical(f"Could not fetch from Index Base\n{query}", exc_info=True)
-        finally:
-            cursor.close()
-            conn.close()
-            self.logger.debug("Closing Stonks DB connections")
 
-    def upsert_stocks(self, stock_df):
-        conn = self.get_connection(self.db_params)
-        cursor = conn.cursor()
+    def get_stock_symbols(self, index_id):
+        """
+        :param index_id: index_id from index_base
+        :return: dict of symbol -> True when the stock is currently listed
+        """
+        query = """
+        SELECT symbol, delistedon IS NULL
+        FROM stock_base
+        WHERE index_id = %s
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (index_id,))
+                result = dict(cursor.fetchall())
+            self.logger.debug(f"Fetch symbols from Stock Base Successful no of records:{len(result)}")
+            return result
+        except (Exception, Error):
+            self.logger.critical(f"Could not fetch from Stock Base\n{query}", exc_info=True)
 
-        query = f"""
+    def upsert_stocks(self, stock_df, page_size=500):
+        """
+        Applies only the difference between the index constituents and stock_base: new symbols are inserted,
+        symbols gone from the index are marked delisted and symbols that came back are listed again
+        :param stock_df: dataframe with index_id, symbol, name, date_of_listing, isin_number
+        :return: True when stock_base matches the index
+        """
+        insert_query = """
         INSERT INTO stock_base (index_id, symbol, name, date_of_listing, isin_number)
-        VALUES (%s, %s, %s, %s, %s)
+        VALUES %s
         ON CONFLICT (index_id, symbol)
         DO NOTHING;
         """
-
-        # Convert DataFrame to list of tuples
-        data = [tuple(row) for row in stock_df.values]
+        listing_query = """
+        UPDATE stock_base
+        SET delistedon = CASE WHEN %s THEN NULL ELSE now() END
+        WHERE index_id = %s
+          AND symbol = ANY(%s::text[])
+        """
+        index_ids = stock_df["index_id"].unique()
+        if len(index_ids) != 1:
+            self.logger.error(f"Expected constituents of a single index, got index ids {list(index_ids)}")
+            return False
+        index_id = int(index_ids[0])
+        existing = self.get_stock_symbols(index_id)
+        if existing is None:
+            return False
+
+        symbols = set(stock_df["symbol"])
+        new_rows = [tuple(row) for row in stock_df.values if row[1] not in existing]
+        delisted = [symbol for symbol, listed in existing.items() if listed and symbol not in symbols]
+        relisted = [symbol for symbol, listed in existing.items() if not listed and symbol in symbols]
+        if not (new_rows or delisted or relisted):
+            self.logger.info(f"Stock Base already matches index {index_id} ({len(symbols)} stocks)")
+            return True
 
         try:
-            # Execute the upsert operation
-            cursor.executemany(query, data)
-            conn.commit()
-            self.logger.info(f"Upsert into stock base successful for {stock_df.shape[0]} rows")
+            with self.connection() as conn, conn.cursor() as cursor:
+                if new_rows:
+                    execute_values(cursor, insert_query, new_rows, page_size=page_size)
+                if delisted:
+                    cursor.execute(listing_query, (False, index_id, delisted))
+                if relisted:
+                    cursor.execute(listing_query, (True, index_id, relisted))
+            self.logger.info(f"Stock Base synced with index {index_id}: {len(new_rows)} new, "
+                             f"{len(delisted)} delisted, {len(relisted)} listed again")
+            return True
         except (Exception, Error) as err:
-            self.logger.error(f"Could not upsert into Stock Base\n{query}\n{data}\n{err}", exc_info=True)
-        finally:
-            conn.close()
-            cursor.close()
-            self.logger.debug("Closing Stonks DB connections")
+            self.logger.error(f"Could not upsert into Stock Base\n{insert_query}\n{err}", exc_info=True)
+            return False
 
     def get_stock_without_sector(self, index_id):
-        conn = self.get_connection(self.db_params)
-        cursor = conn.cursor()
         query = f"""select stock_id, symbol, name
                             from stock_base 
                             where sector is null
+                            and delistedon is null
                             and index_id = {index_id}
                             """
         try:
-            cursor.execute(query)
-            result = cursor.fetchall()
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query)
+                result = cursor.fetchall()
             self.logger.debug("Fetch from Stock Base Successful")
             return result
         except (Exception, Error):
             self.logger.critical(f"Could not fetch from Stock Base\n{query}", exc_info=True)
-        finally:
-            cursor.close()
-            conn.close()
-            self.logger.debug("Closing Stonks DB connections")
 
     def update_stock_sector(self, data):
-        conn = self.get_connection(self.db_params)
-        cursor = conn.cursor()
         # ("UPDATE your_table SET column1 = %s, column2 = %s WHERE condition_column = %s")
         query = f"""
                 UPDATE public.stock_base 
@@ -104,93 +171,310 @@ class DBUtils:
                 """
         try:
             # Execute the upsert operation
-            cursor.execute(query, data)
-            conn.commit()
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, data)
             self.logger.info(f"Upsert successful stock_id: {data[-1]}")
         except (Exception, Error) as err:
             self.logger.error(f"Could not upsert into Stock Base\n{query}\n{data}\n{err}", exc_info=True)
             sys.exit()
-        finally:
-            conn.close()
-            cursor.close()
-            self.logger.debug("Closing Stonks DB connections")
 
-    def get_stock_urls(self, index_id):
-        conn = self.get_connection(self.db_params)
-        cursor = conn.cursor()
+    def update_stock_sector_batch(self, rows, page_size=200):
+        """
+        Set based variant of update_stock_sector, errors are logged instead of ending the process
+        :param rows: list of (sector, industry, about, stock_id), an about of None keeps the stored one
+        :param page_size: rows per VALUES list sent to the server
+        :return: number of rows sent
+        """
+        if not rows:
+            return 0
+        query = """
+                UPDATE public.stock_base sb
+                set sector = v.sector,
+                industry = v.industry,
+                about = COALESCE(v.about, sb.about)
+                FROM (VALUES %s) AS v(sector, industry, about, stock_id)
+                WHERE sb.stock_id = v.stock_id
+                """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                execute_values(cursor, query, rows, template="(%s::text, %s::text, %s::text, %s::integer)",
+                               page_size=page_size)
+            self.logger.info(f"Batch sector update successful for {len(rows)} stocks")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not batch update Stock Base\n{query}\n{err}", exc_info=True)
+            return 0
 
-        query = f"""
-        SELECT sector, 
-           ARRAY_AGG('https://www.screener.in/company/' || symbol || '/consolidated/') AS urls,
-           ARRAY_AGG(sb.stock_id) AS stock_ids
+    def migrate_stock_base(self):
+        """
+        Adds the screener url resolution cache, delisting and statement variant columns to stock_base,
+        safe to run on every start
+        :return: None
+        """
+        query = """
+        ALTER TABLE stock_base ADD COLUMN IF NOT EXISTS screener_url text;
+        ALTER TABLE stock_base ADD COLUMN IF NOT EXISTS screener_url_resolvedon timestamp;
+        ALTER TABLE stock_base ADD COLUMN IF NOT EXISTS delistedon timestamp;
+        ALTER TABLE stock_base ADD COLUMN IF NOT EXISTS statement_variant text;
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query)
+            self.logger.debug("Stock Base migration successful")
+        except (Exception, Error):
+            self.logger.critical(f"Could not migrate Stock Base\n{query}", exc_info=True)
+
+    def get_screener_urls(self, index_id):
+        """
+        :param index_id: index_id from index_base
+        :return: dict of symbol -> (stock_id, screener_url, screener_url_resolvedon)
+        """
+        query = """
+        SELECT symbol, stock_id, screener_url, screener_url_resolvedon
+        FROM stock_base
+        WHERE index_id = %s
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (index_id,))
+                result = {row[0]: row[1:] for row in cursor.fetchall()}
+            self.logger.debug(f"Fetch screener urls from Stock Base Successful no of records:{len(result)}")
+            return result
+        except (Exception, Error):
+            self.logger.critical(f"Could not fetch from Stock Base\n{query}", exc_info=True)
+
+    def update_screener_urls(self, rows, page_size=500):
+        """
+        Stores resolved screener urls, a NULL url records that the search found nothing
+        :param rows: list of (screener_url or None, stock_id)
+        :return: number of rows sent
+        """
+        query = """
+        UPDATE stock_base sb
+        SET screener_url = v.screener_url,
+            screener_url_resolvedon = now()
+        FROM (VALUES %s) AS v(screener_url, stock_id)
+        WHERE sb.stock_id = v.stock_id
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                execute_values(cursor, query, rows, template="(%s::text, %s::integer)", page_size=page_size)
+            self.logger.info(f"Stored screener urls for {len(rows)} stocks")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Stock Base\n{query}\n{err}", exc_info=True)
+            return 0
+
+    def invalidate_screener_urls(self, index_id, symbols=None):
+        """
+        Clears cached screener urls so they are resolved again
+        :param index_id: index_id from index_base
+        :param symbols: symbols to clear, the whole index when None
+        :return: None
+        """
+        query = """
+        UPDATE stock_base
+        SET screener_url = NULL,
+            screener_url_resolvedon = NULL
+        WHERE index_id = %s
+          AND (%s::text[] IS NULL OR symbol = ANY(%s::text[]))
+        """
+        symbols = list(symbols) if symbols is not None else None
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (index_id, symbols, symbols))
+            self.logger.info(f"Invalidated screener urls for index {index_id}")
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Stock Base\n{query}\n{err}", exc_info=True)
+
+    def get_statement_variants(self, index_id):
+        """
+        Statement variant, consolidated or standalone, whose page last gave valid yearly data
+        :param index_id: index_id from index_base
+        :return: dict of stock_id -> variant, stocks never parsed are left out
+        """
+        query = """
+        SELECT stock_id, statement_variant
+        FROM stock_base
+        WHERE index_id = %s
+          AND statement_variant IS NOT NULL
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (index_id,))
+                result = dict(cursor.fetchall())
+            self.logger.debug(f"Fetch statement variants from Stock Base Successful no of records:{len(result)}")
+            return result
+        except (Exception, Error):
+            self.logger.critical(f"Could not fetch from Stock Base\n{query}", exc_info=True)
+            return {}
+
+    def update_statement_variants(self, rows, page_size=500):
+        """
+        :param rows: list of (statement_variant, stock_id)
+        :return: number of rows sent
+        """
+        query = """
+        UPDATE stock_base sb
+        SET statement_variant = v.statement_variant
+        FROM (VALUES %s) AS v(statement_variant, stock_id)
+        WHERE sb.stock_id = v.stock_id
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                execute_values(cursor, query, rows, template="(%s::text, %s::integer)", page_size=page_size)
+            self.logger.info(f"Stored statement variants for {len(rows)} stocks")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Stock Base\n{query}\n{err}", exc_info=True)
+            return 0
+
+    def get_stale_stocks(self, index_id, max_age='15 day'):
+        """
+        Stocks whose page is due for a refresh, most outdated first: never fetched, then by the last fetch or check
+        :param index_id: index_id from index_base
+        :param max_age: pages checked more recently than this are skipped
+        :return: list of (stock_id, consolidated url)
+        """
+        query = """
+        SELECT sb.stock_id,
+               'https://www.screener.in/company/' || sb.symbol || '/consolidated/' AS url
         FROM stock_base sb
-        LEFT JOIN raw_soup_base rsb ON sb.stock_id = rsb.stock_id 
-        WHERE sb.index_id = {index_id}
-          AND (rsb.stock_id IS NULL OR now() - rsb.modifiedon > INTERVAL '15 day')
-        GROUP BY sector
-        ORDER BY COUNT(symbol) DESC;
+        LEFT JOIN raw_soup_base rsb ON sb.stock_id = rsb.stock_id
+        WHERE sb.index_id = %s
+          AND sb.delistedon IS NULL
+          AND (rsb.stock_id IS NULL OR now() - COALESCE(rsb.checkedon, rsb.modifiedon) > %s::interval)
+        ORDER BY COALESCE(rsb.checkedon, rsb.modifiedon) ASC NULLS FIRST, sb.stock_id
         """
         try:
-            cursor.execute(query)
-            result = cursor.fetchall()
-            self.logger.debug(f"Fetch URLs from Stock Base Successful no of records:{len(result)} records")
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (index_id, max_age))
+                result = cursor.fetchall()
+            self.logger.debug(f"Fetch stale stocks from Stock Base Successful no of records:{len(result)}")
             return result
         except (Exception, Error):
             self.logger.critical(f"Could not fetch from Stock Base\n{query}", exc_info=True)
-        finally:
-            cursor.close()
-            conn.close()
-            self.logger.debug("Closing Stonks DB connections")
 
-    def upsert_soup(self, stock_id, soup):
-        print(f'Upserting {stock_id} : soup length->{len(soup)}')
-        conn = self.get_connection(self.db_params)
-        cursor = conn.cursor()
+    def migrate_raw_soup_base(self):
+        """
+        Adds the compressed page and fingerprint columns to raw_soup_base, safe to run on every start
+        :return: None
+        """
+        query = """
+        ALTER TABLE raw_soup_base ADD COLUMN IF NOT EXISTS screener_soup_zip bytea;
+        ALTER TABLE raw_soup_base ALTER COLUMN screener_soup DROP NOT NULL;
+        ALTER TABLE raw_soup_base ADD COLUMN IF NOT EXISTS etag text;
+        ALTER TABLE raw_soup_base ADD COLUMN IF NOT EXISTS last_modified text;
+        ALTER TABLE raw_soup_base ADD COLUMN IF NOT EXISTS content_hash text;
+        ALTER TABLE raw_soup_base ADD COLUMN IF NOT EXISTS checkedon date;
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query)
+            self.logger.debug("Raw Soup Base migration successful")
+        except (Exception, Error):
+            self.logger.critical(f"Could not migrate Raw Soup Base\n{query}", exc_info=True)
+
+    def get_page_fingerprints(self, index_id):
+        """
+        Fingerprints of the stored pages, used to send conditional requests and detect unchanged pages
+        :param index_id: index_id from index_base
+        :return: dict of stock_id -> PageFingerprint
+        """
+        query = """
+        SELECT rsb.stock_id, rsb.etag, rsb.last_modified, rsb.content_hash
+        FROM raw_soup_base rsb
+        JOIN stock_base sb ON sb.stock_id = rsb.stock_id
+        WHERE sb.index_id = %s
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (index_id,))
+                result = {row[0]: PageFingerprint(*row[1:]) for row in cursor.fetchall()}
+            self.logger.debug(f"Fetch fingerprints from Raw Soup Base Successful no of records:{len(result)}")
+            return result
+        except (Exception, Error):
+            self.logger.critical(f"Could not fetch from Raw Soup Base\n{query}", exc_info=True)
+            return {}
+
+    def upsert_soup(self, stock_id, soup, fingerprint=None):
+        """
+        Stores the page compressed in screener_soup_zip, the legacy text column is cleared
+        :param stock_id: stock_id from stock_base
+        :param soup: raw response body, bytes or str
+        :param fingerprint: PageFingerprint of the response
+        :return: None
+        """
+        soup_zip = compress_page(soup, trim=self.trim_soup)
+        fingerprint = fingerprint or PageFingerprint(None, None, None)
+        print(f'Upserting {stock_id} : soup length->{len(soup)} compressed->{len(soup_zip)}')
 
         query = """
-        INSERT INTO raw_soup_base (stock_id, screener_soup, modifiedon)
-        VALUES (%s, %s, current_date)
+        INSERT INTO raw_soup_base (stock_id, screener_soup, screener_soup_zip, etag, last_modified, content_hash,
+                                   modifiedon, checkedon)
+        VALUES (%s, NULL, %s, %s, %s, %s, current_date, current_date)
         ON CONFLICT (stock_id) DO UPDATE SET
-            screener_soup = EXCLUDED.screener_soup,
-            modifiedon = CURRENT_DATE;
+            screener_soup = NULL,
+            screener_soup_zip = EXCLUDED.screener_soup_zip,
+            etag = EXCLUDED.etag,
+            last_modified = EXCLUDED.last_modified,
+            content_hash = EXCLUDED.content_hash,
+            modifiedon = CURRENT_DATE,
+            checkedon = CURRENT_DATE;
         """
         try:
-            cursor.execute(query, (stock_id, soup))
-            conn.commit()
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (stock_id, psycopg2.Binary(soup_zip), *fingerprint))
             self.logger.info(f"Upsert into soup base successful for {stock_id}")
         except (Exception, Error) as err:
-            self.logger.error(f"Could not upsert into Stock Base\n{query}\n{soup}\n{err}", exc_info=True)
-        finally:
-            conn.close()
-            cursor.close()
-            self.logger.debug("Closing Stonks DB connections")
+            self.logger.error(f"Could not upsert into Raw Soup Base\n{query}\n{err}", exc_info=True)
 
     def get_soup_base(self):
-        conn = self.get_connection(self.db_params)
-        cursor = conn.cursor()
-
         query = f"""
-                select stock_id, screener_soup
+                select stock_id, screener_soup, screener_soup_zip
                 from raw_soup_base
                 where  now() - modifiedon < INTERVAL '1 month'
                 order by stock_id
                 """
         try:
-            cursor.execute(query)
-            result = cursor.fetchall()
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query)
+                result = [self._decode_soup_row(row) for row in cursor.fetchall()]
             self.logger.debug("Fetch URLs from Raw Soup Base Successful")
             return result
         except (Exception, Error):
             self.logger.critical(f"Could not fetch from Raw Soup Base\n{query}", exc_info=True)
-        finally:
-            cursor.close()
-            conn.close()
-            self.logger.debug("Closing Stonks DB connections")
+
+    @staticmethod
+    def _decode_soup_row(row):
+        stock_id, soup, soup_zip = row
+        return stock_id, decode_soup(soup, soup_zip)
+
+    def iter_soup_base(self, batch_size=200, interval='1 month', decode=True):
+        """
+        Streams raw_soup_base through a server side cursor so only one batch is held in memory
+        :param batch_size: rows fetched per round trip and yielded together
+        :param interval: only rows modified within this postgres interval
+        :param decode: decompress here, pass False to get (stock_id, screener_soup, screener_soup_zip) rows
+        :return: generator of row lists
+        """
+        query = """
+                select stock_id, screener_soup, screener_soup_zip
+                from raw_soup_base
+                where  now() - modifiedon < %s::interval
+                order by stock_id
+                """
+        with self.connection() as conn, conn.cursor(name='raw_soup_stream') as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query, (interval,))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [self._decode_soup_row(row) for row in rows] if decode else rows
 
     def upsert_yearly_fundamentals(self, stock_id, col_headers, yearly_data):
         print(f'Upserting {stock_id} : fundamental data for {len(yearly_data.keys())} years')
-        conn = self.get_connection(self.db_params)
-        cursor = conn.cursor()
 
         columns = ', '.join(col_headers)
 
@@ -226,22 +510,386 @@ class DBUtils:
             values.append(year_values)
 
         try:
-            cursor.executemany(query, values)
-            conn.commit()
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.executemany(query, values)
             self.logger.info(f"Upsert into soup base successful for {stock_id} ")
         except (Exception, Error) as err:
             self.logger.error(f"Could not upsert into Stock Base\n{query}\n\n{err}", exc_info=True)
-        finally:
-            conn.close()
-            cursor.close()
-            self.logger.debug("Closing Stonks DB connections")
+
+    def upsert_soup_batch(self, rows, page_size=100):
+        """
+        Set based variant of upsert_soup, writes many stocks in one statement and one transaction
+        :param rows: list of (stock_id, soup, fingerprint) tuples, later entries win for a repeated stock_id
+        :param page_size: rows per VALUES list sent to the server
+        :return: number of rows written
+        """
+        rows = {stock_id: (soup, fingerprint or PageFingerprint(None, None, None))
+                for stock_id, soup, fingerprint in rows}
+        rows = [(stock_id, psycopg2.Binary(compress_page(soup, trim=self.trim_soup)), *fingerprint)
+                for stock_id, (soup, fingerprint) in rows.items()]
+        if not rows:
+            return 0
+        query = """
+        INSERT INTO raw_soup_base (stock_id, screener_soup, screener_soup_zip, etag, last_modified, content_hash,
+                                   modifiedon, checkedon)
+        VALUES %s
+        ON CONFLICT (stock_id) DO UPDATE SET
+            screener_soup = NULL,
+            screener_soup_zip = EXCLUDED.screener_soup_zip,
+            etag = EXCLUDED.etag,
+            last_modified = EXCLUDED.last_modified,
+            content_hash = EXCLUDED.content_hash,
+            modifiedon = CURRENT_DATE,
+            checkedon = CURRENT_DATE;
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                execute_values(cursor, query, rows, page_size=page_size,
+                               template="(%s, NULL, %s, %s, %s, %s, current_date, current_date)")
+            self.logger.info(f"Batch upsert into soup base successful for {len(rows)} stocks")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not batch upsert into Raw Soup Base\n{query}\n{err}", exc_info=True)
+            return 0
+
+    def mark_soup_unchanged_batch(self, rows, page_size=500):
+        """
+        Records that stored pages were re-checked and found unchanged, the page itself is not rewritten
+        :param rows: list of (stock_id, fingerprint) tuples, validators from the latest response
+        :param page_size: rows per VALUES list sent to the server
+        :return: number of rows updated
+        """
+        rows = {stock_id: fingerprint or PageFingerprint(None, None, None) for stock_id, fingerprint in rows}
+        rows = [(stock_id, fingerprint.etag, fingerprint.last_modified) for stock_id, fingerprint in rows.items()]
+        if not rows:
+            return 0
+        query = """
+        UPDATE raw_soup_base rsb SET
+            etag = COALESCE(v.etag, rsb.etag),
+            last_modified = COALESCE(v.last_modified, rsb.last_modified),
+            checkedon = CURRENT_DATE
+        FROM (VALUES %s) AS v(stock_id, etag, last_modified)
+        WHERE rsb.stock_id = v.stock_id
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                execute_values(cursor, query, rows, template="(%s::integer, %s::text, %s::text)", page_size=page_size)
+            self.logger.info(f"Marked {len(rows)} unchanged pages in soup base")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Raw Soup Base\n{query}\n{err}", exc_info=True)
+            return 0
+
+    def get_yearly_fundamentals(self, index_id):
+        """
+        Every yearly_financial_data row of an index, e.g. for FundamentalsPanel.from_rows.
+        Only the numeric metric columns are read, their names come back lowercased as Postgres folds them.
+        :param index_id: index_id from index_base
+        :return: (column names, rows)
+        """
+        columns_query = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name = 'yearly_financial_data'
+          AND table_schema = current_schema()
+          AND column_name NOT IN ('stock_id', 'year')
+          AND data_type IN ('smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision')
+        ORDER BY ordinal_position
+        """
+        query = columns_query
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(columns_query)
+                metrics = ''.join(f', yfd.{row[0]}' for row in cursor.fetchall())
+                query = f"""
+                SELECT yfd.stock_id, yfd.year{metrics}
+                FROM yearly_financial_data yfd
+                JOIN stock_base sb ON sb.stock_id = yfd.stock_id
+                WHERE sb.index_id = %s
+                ORDER BY yfd.stock_id, yfd.year
+                """
+                cursor.execute(query, (index_id,))
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+            self.logger.debug(f"Fetch from Yearly Financial Data Successful no of records:{len(rows)}")
+            return columns, rows
+        except (Exception, Error):
+            self.logger.critical(f"Could not fetch from Yearly Financial Data\n{query}", exc_info=True)
+
+    def upsert_yearly_fundamentals_batch(self, col_headers, rows, page_size=500):
+        """
+        Set based variant of upsert_yearly_fundamentals for rows of many stocks sharing the same columns
+        :param col_headers: metric columns present in every row
+        :param rows: list of [stock_id, year, *values], later entries win for a repeated (stock_id, year)
+        :param page_size: rows per VALUES list sent to the server
+        :return: number of rows written
+        """
+        # ON CONFLICT cannot touch the same row twice within one statement
+        rows = list({(row[0], row[1]): row for row in rows}.values())
+        if not rows:
+            return 0
+        columns = ', '.join(col_headers)
+        update_values = ', '.join([f"{col} = EXCLUDED.{col}" for col in col_headers])
+        query = f"""
+            INSERT INTO yearly_financial_data (
+                stock_id,
+                year,
+                {columns}
+            )
+            VALUES %s
+            ON CONFLICT (stock_id, year) DO UPDATE
+            SET {update_values}
+            """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                execute_values(cursor, query, rows, page_size=page_size)
+            self.logger.info(f"Batch upsert into yearly financial data successful for {len(rows)} rows")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not batch upsert into Yearly Financial Data\n{query}\n{err}", exc_info=True)
+            return 0
+
+
+    def migrate_crawl_job(self):
+        """
+        Creates the durable job table the crawlers lease work from, safe to run on every start
+        :return: None
+        """
+        query = """
+        CREATE TABLE IF NOT EXISTS crawl_job (
+            stock_id integer NOT NULL,
+            task text NOT NULL,
+            state text NOT NULL DEFAULT 'pending',
+            attempts integer NOT NULL DEFAULT 0,
+            last_error text,
+            next_attempt_at timestamp NOT NULL DEFAULT now(),
+            modifiedon timestamp NOT NULL DEFAULT now(),
+            PRIMARY KEY (stock_id, task)
+        );
+        ALTER TABLE crawl_job ADD COLUMN IF NOT EXISTS priority double precision;
+        ALTER TABLE crawl_job ADD COLUMN IF NOT EXISTS leased_by text;
+        ALTER TABLE crawl_job ADD COLUMN IF NOT EXISTS lease_expires_at timestamp;
+        CREATE INDEX IF NOT EXISTS crawl_job_due_idx ON crawl_job (task, state, next_attempt_at);
+        CREATE INDEX IF NOT EXISTS crawl_job_lease_idx ON crawl_job (task, leased_by) WHERE state = 'running';
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query)
+            self.logger.debug("Crawl Job migration successful")
+        except (Exception, Error):
+            self.logger.critical(f"Could not migrate Crawl Job\n{query}", exc_info=True)
+
+    def enqueue_jobs(self, task, stock_ids, priorities=None, failed_cooldown='7 day', page_size=1000):
+        """
+        Adds pending jobs. Finished jobs are queued again, failed ones once failed_cooldown has passed since their
+        last retry was due, pending and running ones keep their state
+        :param task: task type, e.g. fundamentals or sector
+        :param stock_ids: stocks that need the task
+        :param priorities: optional dict of stock_id -> number, lower numbers are claimed first
+        :param failed_cooldown: interval after which a job that ran out of attempts gets a fresh set, '0' for now
+        :return: number of stocks sent
+        """
+        requeue = """(crawl_job.state = 'done' OR (crawl_job.state = 'failed'
+                      AND crawl_job.next_attempt_at + %(failed_cooldown)s::interval <= now()))"""
+        query = f"""
+        INSERT INTO crawl_job (stock_id, task, priority)
+        VALUES %(rows)s
+        ON CONFLICT (stock_id, task) DO UPDATE
+        SET priority = EXCLUDED.priority,
+            state = CASE WHEN {requeue} THEN 'pending' ELSE crawl_job.state END,
+            attempts = CASE WHEN {requeue} THEN 0 ELSE crawl_job.attempts END,
+            last_error = CASE WHEN {requeue} THEN NULL ELSE crawl_job.last_error END,
+            next_attempt_at = CASE WHEN {requeue} THEN now() ELSE crawl_job.next_attempt_at END,
+            modifiedon = now()
+        """
+        priorities = priorities or {}
+        rows = [(stock_id, task, priorities.get(stock_id)) for stock_id in set(stock_ids)]
+        if not rows:
+            return 0
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                # execute_values only substitutes the VALUES list, the cooldown is bound first
+                query = cursor.mogrify(query.replace('%(rows)s', '%%s'), {'failed_cooldown': failed_cooldown})
+                execute_values(cursor, query.decode(), rows, template="(%s, %s, %s::double precision)",
+                               page_size=page_size)
+            self.logger.info(f"Queued {len(rows)} {task} jobs")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not enqueue into Crawl Job\n{query}\n{err}", exc_info=True)
+            return 0
+
+    def reset_running_jobs(self, task, worker_id):
+        """
+        Hands back jobs this worker still holds, e.g. after an interrupted run, their attempt is not counted.
+        Jobs of other workers are left to their lease expiring.
+        :param task: task type
+        :param worker_id: id the jobs were leased under
+        :return: None
+        """
+        query = """
+        UPDATE crawl_job
+        SET state = 'pending',
+            attempts = GREATEST(attempts - 1, 0),
+            leased_by = NULL,
+            lease_expires_at = NULL,
+            modifiedon = now()
+        WHERE task = %s
+          AND state = 'running'
+          AND (leased_by = %s OR leased_by IS NULL)
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (task, worker_id))
+                if cursor.rowcount:
+                    self.logger.info(f"Released {cursor.rowcount} unfinished {task} jobs of {worker_id}")
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Crawl Job\n{query}\n{err}", exc_info=True)
+
+    def claim_jobs(self, task, worker_id, limit=None, lease_seconds=600):
+        """
+        Leases due jobs to one worker, rows locked by a concurrent claim are skipped so workers never share a job.
+        Jobs whose lease expired, e.g. because their worker died, are due again.
+        :param task: task type
+        :param worker_id: id of the claiming worker, e.g. host:pid
+        :param limit: most jobs to claim, all due jobs when None
+        :param lease_seconds: how long the jobs stay leased without a heartbeat
+        :return: list of (stock_id, symbol, name), lowest priority number first
+        """
+        query = """
+        WITH due AS (
+            SELECT stock_id
+            FROM crawl_job
+            WHERE task = %(task)s
+              AND ((state = 'pending' AND next_attempt_at <= now())
+                   OR (state = 'running' AND lease_expires_at < now()))
+            ORDER BY priority NULLS LAST, next_attempt_at
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        ), claimed AS (
+            UPDATE crawl_job cj
+            SET state = 'running',
+                attempts = cj.attempts + 1,
+                leased_by = %(worker_id)s,
+                lease_expires_at = now() + make_interval(secs => %(lease_seconds)s),
+                modifiedon = now()
+            FROM due
+            WHERE cj.task = %(task)s
+              AND cj.stock_id = due.stock_id
+            RETURNING cj.stock_id, cj.priority
+        )
+        SELECT c.stock_id, sb.symbol, sb.name
+        FROM claimed c
+        JOIN stock_base sb ON sb.stock_id = c.stock_id
+        ORDER BY c.priority NULLS LAST, c.stock_id
+        """
+        params = {'task': task, 'worker_id': worker_id, 'limit': limit, 'lease_seconds': lease_seconds}
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, params)
+                result = cursor.fetchall()
+            self.logger.debug(f"Claimed {len(result)} {task} jobs for {worker_id}")
+            return result
+        except (Exception, Error):
+            self.logger.critical(f"Could not claim from Crawl Job\n{query}", exc_info=True)
+            return []
+
+    def extend_leases(self, task, worker_id, lease_seconds=600):
+        """
+        Heartbeat, keeps the jobs a live worker is still processing from expiring
+        :return: number of leases extended
+        """
+        query = """
+        UPDATE crawl_job
+        SET lease_expires_at = now() + make_interval(secs => %s)
+        WHERE task = %s
+          AND state = 'running'
+          AND leased_by = %s
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (lease_seconds, task, worker_id))
+                return cursor.rowcount
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Crawl Job\n{query}\n{err}", exc_info=True)
+            return 0
+
+    def complete_jobs(self, task, worker_id, stock_ids):
+        """
+        Only jobs still leased by worker_id are updated, a worker whose lease expired does not overwrite the new owner
+        :param task: task type
+        :param worker_id: worker that ran the jobs
+        :param stock_ids: stocks whose task succeeded
+        :return: number of jobs updated
+        """
+        query = """
+        UPDATE crawl_job
+        SET state = 'done',
+            last_error = NULL,
+            leased_by = NULL,
+            lease_expires_at = NULL,
+            modifiedon = now()
+        WHERE task = %s
+          AND leased_by = %s
+          AND stock_id = ANY(%s)
+        """
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query, (task, worker_id, list(stock_ids)))
+                return cursor.rowcount
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Crawl Job\n{query}\n{err}", exc_info=True)
+            return 0
+
+    def fail_jobs(self, task, worker_id, rows, max_attempts, base_delay, page_size=500):
+        """
+        Records failures, a job is retried after base_delay * 2 ** (attempts - 1) seconds until it runs out of attempts.
+        Only jobs still leased by worker_id are updated
+        :param task: task type
+        :param worker_id: worker that ran the jobs
+        :param rows: list of (stock_id, error message)
+        :param max_attempts: attempts after which the job stays failed
+        :param base_delay: seconds before the first retry
+        :return: number of rows sent
+        """
+        query = """
+        UPDATE crawl_job cj
+        SET state = CASE WHEN cj.attempts >= %(max_attempts)s THEN 'failed' ELSE 'pending' END,
+            last_error = v.last_error,
+            next_attempt_at = now() + make_interval(secs => %(base_delay)s * power(2, GREATEST(cj.attempts - 1, 0))),
+            leased_by = NULL,
+            lease_expires_at = NULL,
+            modifiedon = now()
+        FROM (VALUES %(rows)s) AS v(stock_id, last_error)
+        WHERE cj.task = %(task)s
+          AND cj.leased_by = %(worker_id)s
+          AND cj.stock_id = v.stock_id
+        """
+        if not rows:
+            return 0
+        try:
+            with self.connection() as conn, conn.cursor() as cursor:
+                # execute_values only substitutes the VALUES list, the other parameters are bound first
+                query = cursor.mogrify(query.replace('%(rows)s', '%%s'),
+                                       {'max_attempts': max_attempts, 'base_delay': base_delay, 'task': task,
+                                        'worker_id': worker_id})
+                execute_values(cursor, query.decode(), rows, template="(%s::integer, %s::text)", page_size=page_size)
+            self.logger.info(f"Recorded {len(rows)} failed {task} jobs")
+            return len(rows)
+        except (Exception, Error) as err:
+            self.logger.error(f"Could not update Crawl Job\n{query}\n{err}", exc_info=True)
+            return 0
 
 
 class IndexUtils:
-    def __init__(self, index):
+    # Columns of the index csv that end up in stock_base, after normalising the header names
+    CSV_COLUMNS = {"symbol", "name_of_company", "date_of_listing", "isin_number"}
+
+    def __init__(self, index, cache_dir='index_cache'):
         self.index_id, self.name, self.link, \
             self.link_type, self.country, self.modifiedon = index
         self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self._fetched = None
         # with headers read csv might fail
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0',
@@ -253,36 +901,102 @@ class IndexUtils:
         }
         self.logger.info(f"Processing Index {self.name}")
 
-    def get_stock_details(self):
+    def get_stock_details(self, force=False):
         """
         This function acts as a driver to get stock detail from a particular index
-        :return: dataframe with must-have columns in index_base
+        :param force: parse the csv even when it has not changed since the last saved run
+        :return: dataframe with must-have columns in index_base, None when the csv is unchanged or unreadable
         """
         self.logger.debug(f"Starting to get data from link {self.link}")
         if self.link_type.lower() == 'csv' and 'csv' in self.link.lower():
-            csv_df = self.get_csv_data()
+            csv_df = self.get_csv_data(force=force)
+            if csv_df is None:
+                return None
             formatted_df = self.handle_csv_data(csv_df)
             return formatted_df
 
-    def get_csv_data(self):
+    def _cache_paths(self):
+        base = os.path.join(self.cache_dir, f"index_{self.index_id}")
+        return base + ".csv", base + ".json"
+
+    def _cached_meta(self):
+        _, meta_path = self._cache_paths()
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_csv_data(self, force=False):
         """
-        This function Read dataframe from the index's link(csv)
-        :return: dataframe from csv link
+        This function Read dataframe from the index's link(csv). The download is conditional on the
+        ETag/Last-Modified of the last saved csv and skipped when the body hashes the same
+        :param force: read the csv even when it is unchanged, from the saved copy on a 304
+        :return: dataframe from csv link, None when unchanged or on error
         """
+        meta = self._cached_meta()
+        csv_path, _ = self._cache_paths()
+        headers = dict(self.headers)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
         try:
-            csv_df = pd.read_csv(str(self.link), storage_options=self.headers)
+            response = http_archive.get(str(self.link), headers=headers, timeout=30)
+            if response.status_code == 304:
+                if not force:
+                    self.logger.info(f"Index csv of {self.name} not modified, skipping")
+                    return None
+                with open(csv_path, 'rb') as f:
+                    content = f.read()
+            else:
+                response.raise_for_status()
+                content = response.content
+            csv_hash = hashlib.sha256(content).hexdigest()
+            if csv_hash == meta.get('sha256') and not force:
+                self.logger.info(f"Index csv of {self.name} unchanged, skipping")
+                return None
+            csv_df = pd.read_csv(io.BytesIO(content),
+                                 usecols=lambda col: self._normalise_column(col) in self.CSV_COLUMNS,
+                                 dtype=str)
+            self._fetched = (content, {'sha256': csv_hash,
+                                       'etag': response.headers.get('ETag') or meta.get('etag'),
+                                       'last_modified': response.headers.get('Last-Modified')
+                                       or meta.get('last_modified')})
             self.logger.debug("Read CSV from the link Successful")
             return csv_df
         except Exception as err:
             self.logger.error(f"Cannot Read CSV from the link {self.link}\n{err}", exc_info=True)
 
+    def save_csv_cache(self):
+        """
+        Remembers the csv read by get_csv_data so the next run can skip it, call once stock_base is updated
+        :return: None
+        """
+        if self._fetched is None:
+            return
+        content, meta = self._fetched
+        csv_path, meta_path = self._cache_paths()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(csv_path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(csv_path + '.tmp', csv_path)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        self._fetched = None
+
+    @staticmethod
+    def _normalise_column(col):
+        return col.strip().lower().replace(" ", "_")
+
     def handle_csv_data(self, csv_df):
         """
         This function handles nse based data and creates/renames the required the columns
         :param csv_df: dataframe read from csv
         :return: formatted_df
         """
-        csv_df.rename(columns=lambda x: x.strip().lower().replace(" ", "_"), inplace=True)
+        csv_df.rename(columns=self._normalise_column, inplace=True)
         # Columns used in Index Base
         # stock_id, index_id, symbol, "name", date_of_listing, isin_number, modifiedon
         required_cols = ["index_id", "symbol", "name", "date_of_listing", "isin_number"]